@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# Broadcast cost as the number of connected sessions grows.
+#
+# Compares the old per-session path (json.dumps + console echo + framing for
+# every client) with a single shared BroadcastFrame.
+#
+#   python benchmarks/broadcast.py
+
+import os, sys, json, timeit
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "construct_server"))
+from broadcast_frame import BroadcastFrame, websocket_frame
+
+EVENTS = [dict(
+  type= "change",
+  target= ["e0", "current_temp"],
+  data= 212.4
+)]
+
+class FakeStream(object):
+  def __init__(self): self.written = 0
+  def write(self, data): self.written += len(data)
+
+class LegacyClient(object):
+  def __init__(self, console):
+    self.stream = FakeStream()
+    self.console = console
+
+  def send(self, message):
+    self.console.write("sending:\n%s\n" % message)
+    self.stream.write(websocket_frame(json.dumps(message)))
+
+class SharedFrameClient(object):
+  def __init__(self):
+    self.stream = FakeStream()
+
+  def send_frame(self, frame):
+    self.stream.write(frame.wire())
+
+def legacy_broadcast(clients, events):
+  for client in clients: client.send(events)
+
+def shared_broadcast(clients, events):
+  frame = BroadcastFrame(events)
+  for client in clients: client.send_frame(frame)
+
+def run(n, number=2000):
+  console = open(os.devnull, "w")
+  legacy = [LegacyClient(console) for i in range(n)]
+  shared = [SharedFrameClient() for i in range(n)]
+  t_legacy = timeit.timeit(lambda: legacy_broadcast(legacy, EVENTS), number=number)
+  t_shared = timeit.timeit(lambda: shared_broadcast(shared, EVENTS), number=number)
+  return t_legacy / number * 1e6, t_shared / number * 1e6
+
+if __name__ == "__main__":
+  print "%8s %14s %14s %8s" % ("clients", "legacy (us)", "shared (us)", "speedup")
+  for n in [1, 5, 10, 20, 40, 80, 160]:
+    t_legacy, t_shared = run(n)
+    print "%8i %14.1f %14.1f %7.1fx" % (n, t_legacy, t_shared, t_legacy / t_shared)
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# Command parsing throughput for a realistic dashboard command mix.
+#
+# Reports commands per second for the parser alone (every message parsed)
+# and through the ConstructCmdParser.parse cache.
+#
+#   python benchmarks/cmd_parser.py
+
+import os, sys, time, random
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "construct_server"))
+from construct_cmd_parser import ConstructCmdParser
+
+# (message, relative frequency)
+MIX = [
+  ("move x: 10 @ 200%", 20),
+  ("move x: -10 @ 200%", 20),
+  ("move y: 1", 10),
+  ("move z: -0.1", 10),
+  ("get_jobs", 15),
+  ("set temp e0: 220", 5),
+  ("set temp e0: 220 b0: 70", 5),
+  ("set fan: on", 3),
+  ("set fan: 128", 2),
+  ("home x y", 3),
+  ("home", 3),
+  ("change_job id: 3 position: 0", 2),
+  ("raw G28", 2),
+]
+
+def messages(n):
+  population = [msg for msg, weight in MIX for i in range(weight)]
+  return [random.choice(population) for i in xrange(n)]
+
+def run(parse, msgs):
+  start = time.time()
+  for msg in msgs: parse(msg)
+  return len(msgs) / (time.time() - start)
+
+if __name__ == "__main__":
+  msgs = messages(200000)
+  print "%10s %14s" % ("parser", "commands/s")
+  print "%10s %14.0f" % ("uncached", run(ConstructCmdParser, msgs))
+  print "%10s %14.0f" % ("cached", run(ConstructCmdParser.parse, msgs))
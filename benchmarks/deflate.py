@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# permessage-deflate CPU versus bytes for realistic construct event streams.
+#
+# For each compression level, with and without context takeover, reports the
+# bytes sent (as a percentage of the uncompressed stream) and the CPU time
+# spent per message for:
+#   - sensor: a stream of small temperature change events
+#   - jobs: get_jobs acks and initialized snapshots of a 50 job queue
+#
+#   python benchmarks/deflate.py
+
+import os, sys, time, random
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "construct_server"))
+from broadcast_frame import BroadcastFrame
+from construct_deflate import PerMessageDeflate
+
+def sensor_stream(n):
+  for i in xrange(n):
+    yield [dict(type= "change", target= [random.choice(["e0", "e1", "b0"]),
+      "current_temp"], data= round(random.uniform(20, 230), 1), revision= i)]
+
+def jobs_stream(n):
+  jobs = [dict(id= i, file_name= "plate_%i_bracket_v%i.gcode"%(i, i % 7),
+    status= "queued", total_lines= random.randint(1e4, 1e6), current_line= 0,
+    progress= 0.0) for i in range(50)]
+  for i in xrange(n):
+    if i % 2: yield [dict(type= "ack", data= dict(jobs= jobs))]
+    else: yield [dict(type= "initialized", data= dict(jobs= jobs,
+      session_uuid= "%032x"%random.getrandbits(128), status= "idle",
+      e0= dict(type= "temp", current_temp= 21.5, target_temp= 0,
+        target_temp_countdown= None, blocking= False),
+      sensor_poll_rate= 3000, pause_between_prints= True))]
+
+def run(stream, deflate):
+  raw = sent = 0
+  start = time.clock()
+  for events in stream:
+    frame = BroadcastFrame(events)
+    raw += len(frame.wire())
+    if deflate == None: sent += len(frame.wire())
+    else: sent += len(deflate.wire(frame, "text"))
+  return time.clock() - start, raw, sent
+
+if __name__ == "__main__":
+  n = 5000
+  print "%8s %6s %9s %10s %10s" % ("stream", "level", "takeover", "bytes", "us/msg")
+  for name, stream in [("sensor", sensor_stream), ("jobs", jobs_stream)]:
+    random.seed(1)
+    base, raw, sent = run(stream(n), None)
+    print "%8s %6s %9s %9.1f%% %10.1f" % (name, "-", "-", 100.0, base / n * 1e6)
+    for level in [1, 6, 9]:
+      for takeover in [False, True]:
+        random.seed(1)
+        deflate = PerMessageDeflate(level= level, min_size= 0,
+          context_takeover= takeover, window_bits= 15,
+          client_context_takeover= True)
+        elapsed, raw, sent = run(stream(n), deflate)
+        print "%8s %6i %9s %9.1f%% %10.1f" % (name, level, takeover,
+          100.0 * sent / raw, elapsed / n * 1e6)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# Upload path throughput with and without progress reporting.
+#
+# Feeds a multipart job upload through MultipartStreamParser in 100 KB chunks
+# (as ConstructJobUploadHandler does) and reports MB/s and the number of
+# progress events for: no progress, a progress event per chunk (the old
+# behaviour) and rate limited progress.
+#
+#   python benchmarks/upload.py [size in MB]
+
+import os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "construct_server"))
+from multipart_stream import MultipartStreamParser
+from progress_throttle import ProgressThrottle
+from broadcast_frame import BroadcastFrame
+
+BOUNDARY = "----constructbenchmark"
+CHUNK_SIZE = 100000
+
+def build_upload(size):
+  line = "G1 X102.345 Y87.654 E0.04321 F1800\n"
+  body = line * (size / len(line))
+  return (
+    "--%s\r\nContent-Disposition: form-data; name=\"job\"; "
+    "filename=\"bench.gcode\"\r\nContent-Type: text/plain\r\n\r\n%s\r\n--%s--\r\n"
+  )%(BOUNDARY, body, BOUNDARY)
+
+class NullFile(object):
+  def write(self, data): pass
+  def flush(self): pass
+  def seek(self, offset): pass
+  def close(self): pass
+
+def upload(data, progress):
+  events = [0]
+  def send_progress(read_bytes):
+    event = dict(type= 'change', target= ['session', 'job_upload_progress'],
+      data= dict(uploaded= read_bytes, total= len(data)))
+    BroadcastFrame([event]).wire()
+    events[0] += 1
+  parser = MultipartStreamParser(BOUNDARY, lambda name, filename: NullFile())
+  throttle = ProgressThrottle(len(data))
+  start = time.time()
+  for i in xrange(0, len(data), CHUNK_SIZE):
+    parser.feed(data[i:i + CHUNK_SIZE])
+    read_bytes = min(i + CHUNK_SIZE, len(data))
+    if progress == "every chunk": send_progress(read_bytes)
+    elif progress == "rate limited" and throttle.ready(read_bytes):
+      send_progress(read_bytes)
+  parser.close()
+  return time.time() - start, events[0]
+
+if __name__ == "__main__":
+  size = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+  data = build_upload(size * 1024 * 1024)
+  print "%14s %10s %8s" % ("progress", "MB/s", "events")
+  for progress in ["none", "every chunk", "rate limited"]:
+    elapsed, events = upload(data, progress)
+    print "%14s %10.1f %8i" % (progress, size / elapsed, events)
@@ -0,0 +1,62 @@
+import time
+from tornado.concurrent import Future
+
+class AdaptiveTimer(object):
+  # Repeatedly runs `callback` on the IOLoop. Unlike a PeriodicCallback the
+  # callback returns the number of seconds until it should run again so
+  # polling can back off when there is nothing to do. poke() runs it on the
+  # next IOLoop iteration, for when an event makes polling urgent. The
+  # callback may also return a Future of the delay (a coroutine's), runs never
+  # overlap.
+  def __init__(self, callback, ioloop, clock= time.time):
+    self.callback = callback
+    self.ioloop = ioloop
+    self.clock = clock
+    self._timeout = None
+    self._running = False
+    self._pending = False
+    self._poked = False
+
+  def start(self, delay= 0):
+    self._running = True
+    self._schedule(delay)
+
+  def stop(self):
+    self._running = False
+    self._cancel()
+
+  def poke(self):
+    if not self._running: return
+    if self._pending: self._poked = True
+    else: self._schedule(0)
+
+  def _cancel(self):
+    if self._timeout != None: self.ioloop.remove_timeout(self._timeout)
+    self._timeout = None
+
+  def _schedule(self, delay):
+    self._cancel()
+    self._timeout = self.ioloop.add_timeout(self.clock() + delay, self._run)
+
+  def _run(self):
+    self._timeout = None
+    if not self._running: return
+    delay = None
+    try:
+      delay = self.callback()
+      if isinstance(delay, Future):
+        self._pending = True
+        return self.ioloop.add_future(delay, self._done)
+    finally:
+      # A failing callback is retried rather than stopping the timer
+      if self._running and self._timeout == None and not self._pending:
+        self._schedule(delay if delay != None else 1.0)
+
+  def _done(self, future):
+    self._pending = False
+    poked, self._poked = self._poked, False
+    delay = 0 if poked else None
+    try:
+      if delay == None: delay = future.result()
+    finally:
+      if self._running: self._schedule(delay if delay != None else 1.0)
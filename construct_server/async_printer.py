@@ -0,0 +1,86 @@
+import sys, threading, itertools, Queue
+from tornado.concurrent import TracebackFuture
+
+# Call priorities. Lower runs first, calls of equal priority run in order.
+URGENT = 0
+NORMAL = 1
+STOP = 2
+
+def async_printer(printer, ioloop, threaded= True):
+  # Wraps a printer driver so its methods are called with call(method_name,
+  # *args, **kwargs) and return a Future resolved on the IOLoop.
+  if threaded: return ThreadedPrinter(printer, ioloop)
+  return InlinePrinter(printer)
+
+class InlinePrinter(object):
+  # Calls the driver directly on the IOLoop thread, for drivers that never
+  # block.
+  def __init__(self, printer):
+    self.printer = printer
+
+  def call(self, method_name, *args, **kwargs):
+    future = TracebackFuture()
+    try:
+      future.set_result(getattr(self.printer, method_name)(*args, **kwargs))
+    except Exception:
+      future.set_exc_info(sys.exc_info())
+    return future
+
+  def close(self):
+    pass
+
+class ThreadedPrinter(object):
+  # Calls the driver on a thread of its own so blocking serial I/O doesn't
+  # stall the IOLoop. One thread per printer keeps its calls in order except
+  # for urgent ones (estop) which jump the queue and cancel the calls still
+  # waiting in it.
+  urgent = ["do_estop"]
+
+  def __init__(self, printer, ioloop):
+    self.printer = printer
+    self.ioloop = ioloop
+    self._queue = Queue.PriorityQueue()
+    self._sequence = itertools.count()
+    self._thread = threading.Thread(target= self._run, name= "construct-printer")
+    self._thread.daemon = True
+    self._thread.start()
+
+  def call(self, method_name, *args, **kwargs):
+    future = TracebackFuture()
+    priority = NORMAL
+    if method_name in self.urgent:
+      priority = URGENT
+      self._cancel_pending(method_name)
+    self._queue.put(
+      (priority, next(self._sequence), method_name, args, kwargs, future)
+    )
+    return future
+
+  def _cancel_pending(self, reason):
+    kept = []
+    while True:
+      try:
+        item = self._queue.get_nowait()
+      except Queue.Empty:
+        break
+      priority, n, method_name, args, kwargs, future = item
+      if priority != NORMAL:
+        kept.append(item)
+        continue
+      future.set_exception(Exception("%s cancelled by %s"%(method_name, reason)))
+    for item in kept: self._queue.put(item)
+
+  def _run(self):
+    while True:
+      priority, n, method_name, args, kwargs, future = self._queue.get()
+      if priority == STOP: return
+      try:
+        result = getattr(self.printer, method_name)(*args, **kwargs)
+      except Exception:
+        self.ioloop.add_callback(future.set_exc_info, sys.exc_info())
+      else:
+        self.ioloop.add_callback(future.set_result, result)
+
+  def close(self):
+    self._queue.put((STOP, next(self._sequence), None, None, None, None))
+    self._thread.join(1)
@@ -0,0 +1,71 @@
+import json, struct, zlib
+import construct_binary
+
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+RSV1 = 0x40
+
+OPCODES = dict(text= OPCODE_TEXT, binary= OPCODE_BINARY)
+
+def websocket_frame(payload, opcode=OPCODE_TEXT, rsv1=False):
+  # Server to client frames are never masked (RFC 6455 5.1) so the same bytes
+  # can be written verbatim to every session.
+  first = 0x80 | opcode
+  if rsv1: first |= RSV1
+  length = len(payload)
+  if length < 126:
+    header = struct.pack("!BB", first, length)
+  elif length <= 0xFFFF:
+    header = struct.pack("!BBH", first, 126, length)
+  else:
+    header = struct.pack("!BBQ", first, 127, length)
+  return header + payload
+
+def deflate(compressor, payload):
+  # A permessage-deflate (RFC 7692) message body: sync flushed with the
+  # trailing empty block removed
+  data = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+  return data[:-4]
+
+class BroadcastFrame(object):
+  # A list of construct events serialized once per encoding and shared by
+  # every session it is sent to. An already serialized (text) payload can be
+  # passed in instead of the events.
+  def __init__(self, events, payload= None):
+    self.events = events
+    self.payload = payload if payload != None else json.dumps(events)
+    self._encoded = dict(text= self.payload)
+    self._wire = {}
+
+  def encoded(self, encoding= "text"):
+    try:
+      return self._encoded[encoding]
+    except KeyError:
+      pass
+    events = self.events
+    if events == None: events = json.loads(self.payload)
+    self._encoded[encoding] = construct_binary.pack(events)
+    return self._encoded[encoding]
+
+  def wire(self, encoding= "text"):
+    try:
+      return self._wire[encoding]
+    except KeyError:
+      pass
+    frame = websocket_frame(self.encoded(encoding), OPCODES[encoding])
+    self._wire[encoding] = frame
+    return frame
+
+  def deflated_wire(self, encoding, level, window_bits):
+    # Compressed without context takeover so it is valid for every session
+    # that negotiated the same parameters.
+    key = (encoding, level, window_bits)
+    try:
+      return self._wire[key]
+    except KeyError:
+      pass
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -window_bits)
+    data = deflate(compressor, self.encoded(encoding))
+    frame = websocket_frame(data, OPCODES[encoding], rsv1= True)
+    self._wire[key] = frame
+    return frame
@@ -1,8 +1,16 @@
 import tornado.ioloop
 import tornado.web
 import base64
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+import Queue
 import logging
 import logging.config
+from collections import OrderedDict
 
 log = logging.getLogger("root")
 
@@ -38,11 +46,34 @@ def authenticate(realm, authenticator,user_extractor) :
               self.finish()
 
             return False
+        def _authorized(self, user_info):
+            self._user_info = user_info
+            self._current_user = user_extractor(user_info)
+            log.debug('authenticated user is : %s',
+                      str(self._user_info))
+            return True
+
+        def _verified(user_info):
+            # Resuming the request once the worker thread has verified it
+            self._auth_result = user_info or False
+            self._execute(transforms, *args, **kwargs)
+
         request = self.request
         format = ''
         clazz = self.__class__
         log.debug('intercepting for class : %s', clazz)
+        auth = self.application.auth
         try:
+          if hasattr(self, '_auth_result'):
+              if not self._auth_result:
+                  return _request_basic_auth(self)
+              return _authorized(self, self._auth_result)
+
+          # A signed session token skips verifying the password
+          user_info = auth.verify_token(self.get_argument("token", None))
+          if user_info :
+              return _authorized(self, user_info)
+
           auth_hdr = request.headers.get('Authorization')
 
           if auth_hdr == None:
@@ -53,17 +84,14 @@ def authenticate(realm, authenticator,user_extractor) :
           auth_decoded = base64.decodestring(auth_hdr[6:])
           username, password = auth_decoded.split(':', 2)
 
-          user_info = authenticator(realm, unicode(username), password)
+          user_info = auth.cached(authenticator, realm, unicode(username), password)
           if user_info :
-              self._user_info = user_info
-              self._current_user = user_extractor(user_info)
-              log.debug('authenticated user is : %s',
-                        str(self._user_info))
-          else:
-              return _request_basic_auth(self)
+              return _authorized(self, user_info)
+          auth.verify(authenticator, realm, unicode(username), password,
+                      _verified)
         except Exception, e:
             return _request_basic_auth(self)
-        return True
+        return False
     return wrapper
 
 def interceptor(func):
@@ -104,10 +132,115 @@ def construct_user_extractor(user_data):
     """
     return user_data[0]
 
-def construct_socket_auth(self):
+def construct_socket_auth(self, callback):
+  """
+  Calls callback with the websocket's user info (or None) once its token or
+  user/password parameters are verified
+  """
+  auth = self.application.auth
+  token = self.get_argument("token", None)
+  if token != None: return callback(auth.verify_token(token))
   user = self.get_argument("user", None)
   password = self.get_argument("password", None)
-  return construct_authenticator(None, user, password)
+  auth.verify(construct_authenticator, None, user, password, callback)
+
+class ConstructAuth(object):
+  """
+  Verified credentials are cached for auth_cache_ttl seconds, cache misses
+  are verified on worker threads so slow password hashes don't block the
+  IOLoop and signed session tokens let clients skip passwords altogether.
+  """
+  def __init__(self, settings, clock= time.time):
+    self.clock = clock
+    self.ttl = settings.get("auth_cache_ttl", 300)
+    self.cache_size = settings.get("auth_cache_size", 256)
+    self.token_ttl = settings.get("session_token_ttl", 24 * 60 * 60)
+    # Tokens are invalidated by a restart unless a secret is configured
+    self.secret = settings.get("session_token_secret") or os.urandom(32)
+    self._cache = OrderedDict()
+    # Cached passwords are keyed by a keyed hash rather than kept as is
+    self._cache_key = os.urandom(32)
+    self._queue = Queue.Queue()
+    for i in range(settings.get("auth_workers", 2)):
+      worker = threading.Thread(target= self._work, name= "construct-auth")
+      worker.daemon = True
+      worker.start()
+
+  def _key(self, authenticator, realm, username, password):
+    digest = hmac.new(self._cache_key, password or "", hashlib.sha256).digest()
+    return (authenticator, realm, username, digest)
+
+  def cached(self, authenticator, realm, username, password):
+    key = self._key(authenticator, realm, username, password)
+    expires, user_info = self._cache.get(key, (0, None))
+    if expires < self.clock():
+      self._cache.pop(key, None)
+      return None
+    return user_info
+
+  def _store(self, key, user_info):
+    self._cache.pop(key, None)
+    if len(self._cache) >= self.cache_size: self._cache.popitem(last= False)
+    self._cache[key] = (self.clock() + self.ttl, user_info)
+
+  def verify(self, authenticator, realm, username, password, callback):
+    """
+    Calls callback on the IOLoop with the authenticator's user info or None
+    """
+    user_info = self.cached(authenticator, realm, username, password)
+    if user_info: return callback(user_info)
+    key = self._key(authenticator, realm, username, password)
+    args = (realm, username, password)
+    self._queue.put((authenticator, args, key, callback))
+
+  def _work(self):
+    ioloop = tornado.ioloop.IOLoop.instance()
+    while True:
+      authenticator, args, key, callback = self._queue.get()
+      try:
+        user_info = authenticator(*args)
+      except Exception:
+        log.exception("authenticator failed")
+        user_info = None
+      ioloop.add_callback(self._verified, key, user_info, callback)
+
+  def _verified(self, key, user_info, callback):
+    if user_info: self._store(key, user_info)
+    callback(user_info)
+
+  def _sign(self, payload):
+    return hmac.new(self.secret, payload, hashlib.sha256).hexdigest()
+
+  def issue_token(self, user_info):
+    """
+    Signs the authenticator's user info (which must be JSON serializable)
+    into a token
+    """
+    payload = json.dumps([user_info, int(self.clock() + self.token_ttl)])
+    payload = base64.urlsafe_b64encode(payload)
+    return "%s.%s"%(payload, self._sign(payload))
+
+  def verify_token(self, token):
+    """
+    Returns the user info of a valid, unexpired token or None
+    """
+    try:
+      payload, signature = str(token).rsplit(".", 1)
+      if not _compare_digest(self._sign(payload), signature): return None
+      user_info, expires = json.loads(base64.urlsafe_b64decode(payload))
+      if int(expires) < self.clock(): return None
+      # Tuples (ex: those of basic auth) come back from JSON as lists
+      if type(user_info) == list: user_info = tuple(user_info)
+      return user_info
+    except (UnicodeError, ValueError, TypeError):
+      # Malformed tokens
+      return None
+
+def _compare_digest(a, b):
+  # hmac.compare_digest is only available from python 2.7.7
+  if hasattr(hmac, "compare_digest"): return hmac.compare_digest(a, b)
+  if len(a) != len(b): return False
+  return reduce(lambda r, (x, y): r | (ord(x) ^ ord(y)), zip(a, b), 0) == 0
 
 # interceptor = basic_auth.interceptor
 construct_auth = authenticate(
@@ -0,0 +1,117 @@
+import struct
+
+# The construct.binary subprotocol encodes the same construct events as
+# construct.text using MessagePack (http://msgpack.org/) so that clients can
+# decode it with any MessagePack library.
+
+def pack(obj):
+  out = []
+  _pack(obj, out.append)
+  return "".join(out)
+
+def _pack(obj, write):
+  if obj is None:
+    write("\xc0")
+  elif obj is True:
+    write("\xc3")
+  elif obj is False:
+    write("\xc2")
+  elif isinstance(obj, (int, long)):
+    _pack_int(obj, write)
+  elif isinstance(obj, float):
+    write(struct.pack(">Bd", 0xcb, obj))
+  elif isinstance(obj, basestring):
+    if isinstance(obj, unicode): obj = obj.encode("utf-8")
+    n = len(obj)
+    if n < 32: write(chr(0xa0 | n))
+    elif n <= 0xFF: write(struct.pack(">BB", 0xd9, n))
+    elif n <= 0xFFFF: write(struct.pack(">BH", 0xda, n))
+    else: write(struct.pack(">BI", 0xdb, n))
+    write(obj)
+  elif isinstance(obj, (list, tuple)):
+    n = len(obj)
+    if n < 16: write(chr(0x90 | n))
+    elif n <= 0xFFFF: write(struct.pack(">BH", 0xdc, n))
+    else: write(struct.pack(">BI", 0xdd, n))
+    for v in obj: _pack(v, write)
+  elif isinstance(obj, dict):
+    n = len(obj)
+    if n < 16: write(chr(0x80 | n))
+    elif n <= 0xFFFF: write(struct.pack(">BH", 0xde, n))
+    else: write(struct.pack(">BI", 0xdf, n))
+    for k, v in obj.iteritems():
+      _pack(k, write)
+      _pack(v, write)
+  else:
+    raise TypeError("%r cannot be encoded by construct.binary" % (obj,))
+
+def _pack_int(n, write):
+  if 0 <= n < 128: write(chr(n))
+  elif -32 <= n < 0: write(struct.pack(">b", n))
+  elif 0 <= n <= 0xFF: write(struct.pack(">BB", 0xcc, n))
+  elif 0 <= n <= 0xFFFF: write(struct.pack(">BH", 0xcd, n))
+  elif 0 <= n <= 0xFFFFFFFF: write(struct.pack(">BI", 0xce, n))
+  elif n > 0: write(struct.pack(">BQ", 0xcf, n))
+  elif n >= -0x80: write(struct.pack(">Bb", 0xd0, n))
+  elif n >= -0x8000: write(struct.pack(">Bh", 0xd1, n))
+  elif n >= -0x80000000: write(struct.pack(">Bi", 0xd2, n))
+  else: write(struct.pack(">Bq", 0xd3, n))
+
+def unpack(data):
+  obj, offset = _unpack(data, 0)
+  if offset != len(data): raise ValueError("Trailing construct.binary data")
+  return obj
+
+# (struct format, size) of the fixed size types by their first byte
+_fixed = {
+  0xca: (">f", 4), 0xcb: (">d", 8),
+  0xcc: (">B", 1), 0xcd: (">H", 2), 0xce: (">I", 4), 0xcf: (">Q", 8),
+  0xd0: (">b", 1), 0xd1: (">h", 2), 0xd2: (">i", 4), 0xd3: (">q", 8),
+}
+# (struct format of the length, size of the length, container type)
+_sized = {
+  0xc4: (">B", 1, "bin"), 0xc5: (">H", 2, "bin"), 0xc6: (">I", 4, "bin"),
+  0xd9: (">B", 1, "str"), 0xda: (">H", 2, "str"), 0xdb: (">I", 4, "str"),
+  0xdc: (">H", 2, "array"), 0xdd: (">I", 4, "array"),
+  0xde: (">H", 2, "map"), 0xdf: (">I", 4, "map"),
+}
+
+def _unpack(data, offset):
+  if offset >= len(data): raise ValueError("Truncated construct.binary data")
+  b = ord(data[offset])
+  offset += 1
+  if b < 0x80: return b, offset
+  if b >= 0xe0: return b - 0x100, offset
+  if b == 0xc0: return None, offset
+  if b == 0xc2: return False, offset
+  if b == 0xc3: return True, offset
+  if b in _fixed:
+    fmt, size = _fixed[b]
+    return struct.unpack_from(fmt, data, offset)[0], offset + size
+  if 0xa0 <= b <= 0xbf: return _unpack_container(data, offset, b & 0x1f, "str")
+  if 0x90 <= b <= 0x9f: return _unpack_container(data, offset, b & 0x0f, "array")
+  if 0x80 <= b <= 0x8f: return _unpack_container(data, offset, b & 0x0f, "map")
+  if b in _sized:
+    fmt, size, kind = _sized[b]
+    n = struct.unpack_from(fmt, data, offset)[0]
+    return _unpack_container(data, offset + size, n, kind)
+  raise ValueError("Unsupported construct.binary type 0x%x" % b)
+
+def _unpack_container(data, offset, n, kind):
+  if kind in ["str", "bin"]:
+    if offset + n > len(data): raise ValueError("Truncated construct.binary data")
+    value = data[offset:offset + n]
+    if kind == "str": value = value.decode("utf-8")
+    return value, offset + n
+  if kind == "array":
+    items = []
+    for i in xrange(n):
+      item, offset = _unpack(data, offset)
+      items.append(item)
+    return items, offset
+  items = {}
+  for i in xrange(n):
+    k, offset = _unpack(data, offset)
+    v, offset = _unpack(data, offset)
+    items[k] = v
+  return items, offset
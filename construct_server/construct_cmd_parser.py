@@ -1,60 +1,105 @@
 import textwrap, re
+from collections import OrderedDict
+
+class ConstructCmdParser(object):
+  # Parsed commands are cached by their raw message and shared so they must
+  # be treated as immutable. kwargs returns a copy.
+  cache_size = 256
+  _cache = OrderedDict()
+
+  _token_re = re.compile(r'([^\s:]*):\s*(\S*)|(\S+)')
+  _int_re = re.compile(r'-?[0-9]+$')
+  _float_re = re.compile(r'-?[0-9.]+$')
+
+  @classmethod
+  def parse(cls, msg):
+    # Raw blocks are too large and rarely repeated to be worth caching
+    if "\n" in msg.strip(): return cls(msg)
+    cache = cls._cache
+    try:
+      cmd = cache.pop(msg)
+    except KeyError:
+      cmd = cls(msg)
+      if len(cache) >= cls.cache_size: cache.popitem(last= False)
+    cache[msg] = cmd
+    return cmd
 
-class ConstructCmdParser:
   def __init__(self, msg):
-    cmds = self._cmds
+    args = []
+    kwargs = {}
+    # A raw_block's G-code lines follow its first line
+    first, newline, block = msg.strip().partition("\n")
+    if first.strip().lower() == "raw_block": msg = first
+    else: block = ""
+    tokens = self._token_re.findall(msg.lower().replace("@", " at:"))
+    if len(tokens) == 0: self.err('cmd_not_found', "")
 
-    print "message received: %s"%(msg)
-    msg = re.sub(r'\s+', "\s" ,msg).strip().lower()
-    msg = msg.replace("@", "at:").replace(":\s", ":")
-    words = msg.split("\s")
+    for k, v, word in tokens:
+      if word: args.append(word); continue
+      if (v in ["on", "off"]): v = (v == "on")
+      elif (self._int_re.match(v)): v = int(v)
+      elif (self._float_re.match(v)): v = float(v)
+      kwargs[k] = v
 
-    self.cmd = words[0]
+    self.cmd = args.pop(0) if tokens[0][2] else ""
     self.method_name = "do_%s"%self.cmd
-    self.args = []
-    self.kwargs = {}
-
-    for w in words[1:]:
-      if w.find(":") > -1:
-        k, v = w.split(":")
-        if (v in ["on", "off"]): v = (v == "on")
-        elif (re.match("[0-9]+$", v)): v = int(v)
-        elif (re.match("[0-9\.]+$", v)): v = float(v)
-        self.kwargs[k] = v
-      else:
-        self.args.append(w)
-
-    if not self.cmd in cmds.keys(): self.err('cmd_not_found', self.cmd)
+    self.args = tuple(args)
+    self._kwargs = kwargs
+    if self.cmd == "raw_block": self.args = self.block_lines(block)
+
+    if not self.cmd in self._cmds: self.err('cmd_not_found', self.cmd)
     if not self.is_valid(): self.err('args_err')
     if self.cmd=="set": self.validate_set_cmd()
+    if self.cmd=="get_temp_history": self.validate_history_cmd()
+    if self.cmd=="resume_job": self.validate_resume_cmd()
+
+  @property
+  def kwargs(self):
+    return dict(self._kwargs)
+
+  def block_lines(self, block):
+    # The block's lines without blank lines or comments
+    lines = (line.split(";", 1)[0].strip().lower() for line in block.split("\n"))
+    return tuple(line for line in lines if line)
 
   def is_valid(self):
     cmd = self.cmd
     t = self._cmds[cmd]['type']
 
-    if (len(self.kwargs) > 0  and t in ['none', 'array', 'home'] ): return False
-    if (len(self.args)   > 0  and t in ['none', 'dict']          ): return False
-    if (len(self.kwargs) == 0 and t == 'dict' or cmd == 'set'    ): return False
-    if (len(self.args)   == 0 and t == 'array'                   ): return False
-    if (len(self.args)   > 1  and cmd == 'set'                   ): return False
+    if (len(self._kwargs) > 0 and t in ['none', 'array', 'home', 'block']): return False
+    if (len(self.args)    > 0 and t in ['none', 'dict']                  ): return False
+    if (len(self._kwargs) == 0 and (t == 'dict' or cmd == 'set')         ): return False
+    if (len(self.args)   == 0 and t in ['array', 'block']                ): return False
+    if (len(self.args)   > 1  and cmd == 'set'                           ): return False
     return True
 
   def validate_set_cmd(self):
     if(len(self.args) == 1 and self.args[0] == "temp"):
-      for target, data in self.kwargs.iteritems():
+      for target, data in self._kwargs.iteritems():
         if (not type(data) in [float, int]): self.err('temp_value')
       return
 
     if(len(self.args) != 0): self.err('args_err')
 
-    for k, v in self.kwargs.iteritems():
+    for k, v in self._kwargs.iteritems():
       original_v = v
       if (type(v) == bool): original_v = {True: "on", False: "off"}[v]
       namespaces = ["fan", "conveyor", "motors"]
       if (not k in namespaces): self.err('set_key', k, original_v)
-      if (k == "motors" and type(v) != bool): self.err('motor_value', k)
+      if (k == "motors" and type(v) != bool): self.err('motors_value', k)
       if (not type(v) in [bool, float, int]): self.err('f_or_c_value', k)
 
+  def validate_history_cmd(self):
+    for k, v in self._kwargs.iteritems():
+      if not k in ["since", "until", "points"]: self.err('args_err')
+      if not type(v) in [float, int]: self.err('args_err')
+    if self._kwargs.get('points', 1) < 1: self.err('args_err')
+
+  def validate_resume_cmd(self):
+    if len(self.args) > 0 or len(set(self._kwargs) - set(["line"])) > 0:
+      self.err('args_err')
+    if type(self._kwargs.get('line', 0)) != int: self.err('args_err')
+
   def err(self, key, *args):
     if key == 'args_err': args = [self._cmds[self.cmd]['args_error']]
     raise Exception(self._errors[key](*args))
@@ -67,8 +112,8 @@ class ConstructCmdParser:
       "temperature values must be numeric (ex: set temp e0: 10)",
     set_key       = lambda k, v:
       "invalid key '%s'. Did you mean 'set temp %s: %s'?"%(k,k, v),
-    motors_value  = lambda:
-      "set %s accepts either on or off (ex: set motors: on)",
+    motors_value  = lambda k:
+      "set %s accepts either on or off (ex: set motors: on)"%k,
     f_or_c_value  = lambda k:
       "set %s accepts a numeric speed, on or off (ex: set %s 255)"%(k,k)
   )
@@ -114,14 +159,39 @@ class ConstructCmdParser:
         (ex: change_job id: 5, position: 0).
       """).strip()
     },
+    "resume_job": {
+      'type': None,
+      'args_error': textwrap.dedent("""
+        resume_job optionally accepts the line to resume from
+        (ex: resume_job line: 1200).
+      """).strip()
+    },
     "get_jobs": {
       'type': "none",
       'args_error': "get_jobs does not require any parameters."
     },
+    "get_sessions": {
+      'type': "none",
+      'args_error': "get_sessions does not require any parameters."
+    },
+    "get_temp_history": {
+      'type': None,
+      'args_error': textwrap.dedent("""
+        get_temp_history optionally accepts temperature sensor names and since,
+        until and points values (ex: get_temp_history e0 since: -600 points: 60).
+      """).strip()
+    },
     "raw": {
       'type': "array",
       'args_error': textwrap.dedent("""
         accepts raw commands and passes them on (ex: "raw G28" will pass on the home all axis command)
       """).strip()
     },
+    "raw_block": {
+      'type': "block",
+      'args_error': textwrap.dedent("""
+        raw_block accepts raw commands one per line on the lines following it
+        and passes them on in order (ex: "raw_block\\nG28\\nG1 X10").
+      """).strip()
+    },
   }
@@ -0,0 +1,138 @@
+import zlib, tornado.escape, tornado.websocket
+from broadcast_frame import websocket_frame, deflate, OPCODES, RSV1
+
+# permessage-deflate (RFC 7692) for the construct websocket. Tornado's
+# WebSocketProtocol13 neither negotiates extensions nor accepts frames with
+# RSV1 set so DeflateWebSocketProtocol extends it to do both.
+
+_params = [
+  'server_no_context_takeover', 'client_no_context_takeover',
+  'server_max_window_bits', 'client_max_window_bits'
+]
+
+def is_websocket_upgrade(request):
+  headers = request.headers
+  connection = [s.strip().lower() for s in headers.get("Connection", "").split(",")]
+  return (
+    request.method == "GET" and
+    headers.get("Upgrade", "").lower() == "websocket" and
+    "upgrade" in connection and
+    headers.get("Sec-WebSocket-Version") in ("7", "8", "13")
+  )
+
+def negotiate_deflate(offers, settings):
+  # Returns the PerMessageDeflate for the first acceptable offer in a
+  # Sec-WebSocket-Extensions header or None.
+  if not settings.get("websocket_deflate", True) or not offers: return None
+  for offer in offers.split(","):
+    params = [p.strip() for p in offer.split(";")]
+    if params[0] != "permessage-deflate": continue
+    values = {}
+    for p in params[1:]:
+      k, sep, v = p.partition("=")
+      values[k.strip()] = v.strip().strip('"')
+    if len(set(values) - set(_params)) > 0: continue
+    window_bits = values.get('server_max_window_bits', "15")
+    # zlib can't produce raw deflate streams with an 8 bit window
+    if not window_bits.isdigit() or not 9 <= int(window_bits) <= 15: continue
+    return PerMessageDeflate(
+      level= settings.get("deflate_level", 6),
+      min_size= settings.get("deflate_min_size", 256),
+      context_takeover= settings.get("deflate_context_takeover", False) and
+        not 'server_no_context_takeover' in values,
+      window_bits= int(window_bits),
+      client_context_takeover= not 'client_no_context_takeover' in values,
+      window_bits_requested= 'server_max_window_bits' in values
+    )
+  return None
+
+class PerMessageDeflate(object):
+  # A session's negotiated compression. Without context takeover each
+  # message is compressed on its own so a broadcast is compressed once for
+  # every session. With it each session gets its own compressor, trading CPU
+  # for better compression of similar consecutive messages.
+  def __init__(self, level, min_size, context_takeover, window_bits,
+      client_context_takeover, window_bits_requested= False):
+    self.level = level
+    self.min_size = min_size
+    self.context_takeover = context_takeover
+    self.window_bits = window_bits
+    self.client_context_takeover = client_context_takeover
+    response = ["permessage-deflate"]
+    if not context_takeover: response.append("server_no_context_takeover")
+    if not client_context_takeover:
+      response.append("client_no_context_takeover")
+    if window_bits_requested:
+      response.append("server_max_window_bits=%i" % window_bits)
+    self.response = "; ".join(response)
+    self._compressor = None
+    self._decompressor = None
+
+  def wire(self, frame, encoding):
+    payload = frame.encoded(encoding)
+    # Small messages (most change events) are not worth compressing
+    if len(payload) < self.min_size: return frame.wire(encoding)
+    if not self.context_takeover:
+      return frame.deflated_wire(encoding, self.level, self.window_bits)
+    if self._compressor == None:
+      self._compressor = zlib.compressobj(
+        self.level, zlib.DEFLATED, -self.window_bits
+      )
+    data = deflate(self._compressor, payload)
+    return websocket_frame(data, OPCODES[encoding], rsv1= True)
+
+  def decompress(self, data):
+    if self._decompressor == None or not self.client_context_takeover:
+      self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    return self._decompressor.decompress(data + "\x00\x00\xff\xff")
+
+class DeflateWebSocketProtocol(tornado.websocket.WebSocketProtocol13):
+  def __init__(self, handler, deflate):
+    tornado.websocket.WebSocketProtocol13.__init__(self, handler)
+    self.deflate = deflate
+    self._compressed = False
+
+  def _accept_connection(self):
+    # WebSocketProtocol13._accept_connection with the extension's response
+    subprotocol_header = ''
+    subprotocols = self.request.headers.get("Sec-WebSocket-Protocol", '')
+    subprotocols = [s.strip() for s in subprotocols.split(',')]
+    if subprotocols:
+      selected = self.handler.select_subprotocol(subprotocols)
+      if selected:
+        assert selected in subprotocols
+        subprotocol_header = "Sec-WebSocket-Protocol: %s\r\n" % selected
+
+    self.stream.write(tornado.escape.utf8(
+      "HTTP/1.1 101 Switching Protocols\r\n"
+      "Upgrade: websocket\r\n"
+      "Connection: Upgrade\r\n"
+      "Sec-WebSocket-Accept: %s\r\n"
+      "Sec-WebSocket-Extensions: %s\r\n"
+      "%s"
+      "\r\n" % (
+        self._challenge_response(), self.deflate.response, subprotocol_header
+      )))
+
+    self.async_callback(self.handler.open)(
+      *self.handler.open_args, **self.handler.open_kwargs
+    )
+    self._receive_frame()
+
+  def _on_frame_start(self, data):
+    # RSV1 marks the first frame of a compressed data message
+    header = ord(data[0])
+    if header & RSV1 and header & 0xf in OPCODES.values():
+      self._compressed = True
+      data = chr(header & ~RSV1) + data[1:]
+    tornado.websocket.WebSocketProtocol13._on_frame_start(self, data)
+
+  def _handle_message(self, opcode, data):
+    if self._compressed and opcode in OPCODES.values():
+      self._compressed = False
+      try:
+        data = self.deflate.decompress(data)
+      except zlib.error:
+        self._abort()
+        return
+    tornado.websocket.WebSocketProtocol13._handle_message(self, opcode, data)
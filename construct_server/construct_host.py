@@ -0,0 +1,92 @@
+import os, re, signal, atexit, json, collections, tornado, tornado.web
+from construct_server import ConstructServer, register_dns_sd
+from construct_socket_handler import ConstructSocketHandler
+from construct_job_upload_handler import ConstructJobUploadHandler
+from construct_auth import ConstructAuth, construct_auth, interceptor
+from job_storage import JobStorage
+from job_ingest import JobIngest
+from construct_logging import get_logger, configure_logging
+
+log = get_logger("host")
+
+class ConstructHost(tornado.web.Application):
+  # Hosts many printers in one process and IOLoop. Each printer gets its own
+  # ConstructServer (component tree, job queue, pollers and sessions) served
+  # at /printers/<name>/socket and /printers/<name>/jobs, while the port,
+  # DNS-SD registration, upload storage, job ingest and auth are the host's.
+  #
+  # `printers` is a dict of the ConstructServer kwargs (printer, components,
+  # settings and optionally server_settings overriding the host's) of each
+  # printer by name.
+  def __init__(self, printers, routes= None, server_settings= None):
+    if server_settings == None: server_settings = {}
+    configure_logging(server_settings)
+    self.ioloop = tornado.ioloop.IOLoop.instance()
+    self.port = server_settings.get("port", 8888)
+    # Each printer journals to a directory of its own
+    journal_dir = server_settings.get("journal_dir")
+    self.auth = ConstructAuth(server_settings)
+    self.job_storage = JobStorage(server_settings.get("upload_dir"),
+      sidecars= journal_dir != None
+    )
+    self.job_ingest = JobIngest(self.job_storage, self.ioloop,
+      processes= server_settings.get("ingest_processes"),
+      cache_size= server_settings.get("analysis_cache_size", 256),
+      threads= server_settings.get("ingest_threads", 4)
+    )
+
+    self.printers = collections.OrderedDict()
+    printer_routes = [(r"/printers", ConstructPrintersHandler)]
+    for name in sorted(printers):
+      if not re.match(r"[A-Za-z0-9_-]+$", name):
+        raise Exception("Invalid printer name: %r"%name)
+      config = printers[name]
+      settings = dict(server_settings, **config.get("server_settings", {}))
+      if journal_dir != None: settings['journal_dir'] = os.path.join(journal_dir, name)
+      server = ConstructServer(
+        host= self,
+        printer= config["printer"],
+        routes= None,
+        server_settings= settings,
+        settings= config.get("settings", {}),
+        components= config["components"]
+      )
+      self.printers[name] = server
+      prefix = r"/printers/%s"%name
+      printer_routes += [
+        (prefix + r"/socket", ConstructSocketHandler, dict(server= server)),
+        (prefix + r"/jobs", ConstructJobUploadHandler, dict(server= server)),
+      ]
+    signal.signal(signal.SIGINT, self.sigint_handler)
+    routes = (routes or []) + printer_routes
+    tornado.web.Application.__init__(self, routes, **server_settings)
+
+  def start(self):
+    for server in self.printers.itervalues(): server.start()
+    # One DNS-SD registration for every printer, clients list them at
+    # /printers
+    sdRef = register_dns_sd(self.port)
+    atexit.register(sdRef.close)
+    self.listen(self.port)
+    log.info("Hosting %i printers on port %i", len(self.printers), self.port)
+
+  def sigint_handler(self, signum, frame):
+    log.info("exiting...")
+    self.ioloop.stop()
+    raise Exception("Ctrl+C")
+
+@interceptor(construct_auth)
+class ConstructPrintersHandler(tornado.web.RequestHandler):
+  # The host's printers and their routes
+  def get(self):
+    printers = []
+    for name, server in self.application.printers.iteritems():
+      prefix = "/printers/%s"%name
+      printers.append(dict(
+        name= name,
+        status= server.components['status'],
+        socket= prefix + "/socket",
+        jobs= prefix + "/jobs"
+      ))
+    self.set_header("Content-Type", "application/json")
+    self.finish(json.dumps(dict(printers= printers)))
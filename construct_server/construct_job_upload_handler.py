@@ -1,49 +1,108 @@
-import tornado, uuid
-from cStringIO import StringIO
-from construct_auth import construct_auth
+import tornado, uuid, os, cgi
+from construct_auth import construct_auth, interceptor
+from multipart_stream import MultipartStreamParser
+from progress_throttle import ProgressThrottle
+from construct_logging import get_logger
+
+log = get_logger("upload")
+progress_log = get_logger("upload.progress")
 
 @tornado.web.stream_body
+@interceptor(construct_auth)
 class ConstructJobUploadHandler(tornado.web.RequestHandler):
 
-  def prepare(self):
-    construct_auth(self, None)
+  def initialize(self, server= None):
+    self.server = server or self.application
 
   def post(self):
+    content_type, params = cgi.parse_header(
+      self.request.headers.get("Content-Type", "")
+    )
+    if content_type != "multipart/form-data" or not 'boundary' in params:
+      raise tornado.web.HTTPError(400, "Expected a multipart/form-data upload")
     self.read_bytes = 0
     self.total_bytes = self.request.content_length
-    self.file_str = StringIO()
+    self.spooled = []
+    self.parser = MultipartStreamParser(params['boundary'], self.spool_file)
     self.target = ['session', 'job_upload_progress']
+    settings = self.server.settings
+    self.progress = ProgressThrottle(self.total_bytes,
+      interval= settings.get("upload_progress_interval", 0.5),
+      step= settings.get("upload_progress_step", 1.0)
+    )
     self.websocket = None
     session_uuid = self.get_argument("session_uuid", None)
-    print session_uuid
-    if session_uuid in self.application.clients:
-      self.websocket = self.application.clients[session_uuid]
+    log.debug("upload started for session %s", session_uuid)
+    if session_uuid in self.server.clients:
+      self.websocket = self.server.clients[session_uuid]
     self.request.request_continue()
     self.read_chunks()
 
+  def spool_file(self, name, filename):
+    # Only the job is kept, it is written to disk as it arrives
+    if name != 'job': return None
+    f = self.server.job_storage.spool(filename)
+    self.spooled.append(f)
+    return f
+
   def read_chunks(self, chunk=''):
     self.read_bytes += len(chunk)
-    self.file_str.write(chunk)
+    try:
+      self.parser.feed(chunk)
+    except ValueError as ex:
+      return self.abort_upload(str(ex))
     if chunk: self.process_chunk()
 
     chunk_length = min(100000, self.request.content_length - self.read_bytes)
     if chunk_length > 0:
       self.request.connection.stream.read_bytes(chunk_length, self.read_chunks)
     else:
-      self.request._on_request_body(self.file_str.getvalue(), self.uploaded)
+      try:
+        self.parser.close()
+      except ValueError as ex:
+        return self.abort_upload(str(ex))
+      self.uploaded()
+
+  def abort_upload(self, reason):
+    for f in self.spooled:
+      f.close()
+      os.remove(f.name)
+    self.send_error(400, reason= reason)
 
   def process_chunk(self):
-    print "bytes: (%i / %i)"%(self.read_bytes, self.total_bytes)
+    # The final progress event is sent once the upload is complete
+    if self.read_bytes >= self.total_bytes: return
+    if self.progress.ready(self.read_bytes): self.send_progress()
+
+  def send_progress(self):
+    progress_log.debug("bytes: (%i / %i)", self.read_bytes, self.total_bytes)
     data = dict(uploaded = self.read_bytes, total = self.total_bytes)
     event = dict(type = 'change', target = self.target, data = data)
     if self.websocket != None: self.websocket.send([event])
 
   def uploaded(self):
-    printer = self.application.printer
-    fileinfo = self.request.files['job'][0]
-    body = fileinfo['body']
-    if hasattr(printer, "post_process_print_job"):
-      body = printer.post_process_print_job(fileinfo['filename'], body)
-    self.application.jobs.do_add_job(fileinfo['filename'], body)
-
+    if not 'job' in self.parser.files:
+      return self.abort_upload("Missing job file")
+    self.send_progress()
+    printer = self.server.printer
+    fileinfo = self.parser.files['job'][0]
+    # Optional scheduling fields sent alongside the job file
+    args = self.parser.arguments
+    try:
+      priority = int(args.get('priority', [0])[0])
+      deadline = args.get('deadline', [None])[0]
+      if deadline != None: deadline = float(deadline)
+    except ValueError:
+      return self.abort_upload("Invalid priority or deadline")
+    # Only the first job part is kept
+    for f in self.spooled:
+      if f is fileinfo['file']: continue
+      f.close()
+      os.remove(f.name)
+    # The job is acknowledged once it's spooled, it is post processed and
+    # indexed as a "processing" job in the background
+    self.server.jobs.ingest_job(fileinfo['filename'], fileinfo['file'],
+      priority= priority, deadline= deadline,
+      post_process= getattr(printer, "post_process_print_job", None)
+    )
     self.finish("ACK")
@@ -0,0 +1,96 @@
+import logging, sys, time, threading, Queue
+
+# Construct's loggers all live under "construct" (construct.server,
+# construct.socket, construct.upload, construct.jobs...) so their levels can be
+# set per module. Messages use logging's lazy %-formatting so disabled debug
+# logging on the hot paths costs a level check.
+
+def get_logger(name):
+  return logging.getLogger("construct.%s" % name)
+
+class RateLimitFilter(logging.Filter):
+  # Lets through at most one record per `interval` seconds for each message
+  # template. The next record let through reports how many were suppressed.
+  def __init__(self, interval, clock= time.time):
+    logging.Filter.__init__(self)
+    self.interval = interval
+    self.clock = clock
+    self._last = {}
+
+  def filter(self, record):
+    key = (record.name, record.msg)
+    now = self.clock()
+    last, suppressed = self._last.get(key, (None, 0))
+    if last != None and now - last < self.interval:
+      self._last[key] = (last, suppressed + 1)
+      return False
+    self._last[key] = (now, 0)
+    if suppressed > 0:
+      record.msg = "%s (%i similar messages suppressed)" % (record.msg, suppressed)
+    return True
+
+class ThreadedHandler(logging.Handler):
+  # Formats records on the calling thread and hands them to a background
+  # thread to be written by `handler` so slow consoles and disks don't block
+  # the IOLoop. Records are dropped if `capacity` records are waiting.
+  def __init__(self, handler, capacity= 10000):
+    logging.Handler.__init__(self)
+    self.handler = handler
+    self.dropped = 0
+    self._queue = Queue.Queue(capacity)
+    self._thread = threading.Thread(target= self._run, name= "construct-log")
+    self._thread.daemon = True
+    self._thread.start()
+
+  def emit(self, record):
+    try:
+      # Resolving the message now, its args may change before it is written
+      record.msg = record.getMessage()
+      record.args = None
+      if record.exc_info:
+        record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+      self._queue.put_nowait(record)
+    except Queue.Full:
+      self.dropped += 1
+    except Exception:
+      self.handleError(record)
+
+  def _run(self):
+    while True:
+      record = self._queue.get()
+      if record == None: break
+      self.handler.handle(record)
+
+  def close(self):
+    self._queue.put(None)
+    self._thread.join(1)
+    self.handler.close()
+    logging.Handler.close(self)
+
+# Loggers for events that can fire many times a second
+high_frequency_loggers = ["construct.upload.progress", "construct.socket.messages"]
+
+def configure_logging(settings):
+  # Configures the construct loggers from the server settings, adding a
+  # handler unless the application has already configured logging.
+  root = logging.getLogger("construct")
+  levels = settings.get("log_levels", {})
+  root.setLevel(levels.get("construct", logging.INFO))
+  for name, level in levels.iteritems():
+    logging.getLogger(name).setLevel(level)
+  rate_limit = settings.get("log_rate_limit", 1.0)
+  if rate_limit:
+    for name in high_frequency_loggers:
+      logger = logging.getLogger(name)
+      if not any(isinstance(f, RateLimitFilter) for f in logger.filters):
+        logger.addFilter(RateLimitFilter(rate_limit))
+  # Logs go to the application's handlers if it has configured any, on the
+  # construct logger or the root logger
+  if len(root.handlers) > 0 or len(logging.getLogger().handlers) > 0: return
+  handler = logging.StreamHandler(sys.stdout)
+  handler.setFormatter(logging.Formatter("%(asctime)s %(name)s: %(message)s"))
+  if settings.get("log_async", False): handler = ThreadedHandler(handler)
+  root.addHandler(handler)
+  # Tornado adds a root handler if there is none, it would log these twice
+  root.propagate = False
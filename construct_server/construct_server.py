@@ -1,39 +1,121 @@
 import signal, time, sys, glob, os, codecs, pybonjour, atexit, tornado
-import inflection, copy, types
+import inflection, copy, types, contextlib, collections, json, tornado.gen, uuid
+import thread, functools
 
 # Infastructure
 from event_emitter import EventEmitter
 from print_job_queue import PrintJobQueue
+from broadcast_frame import BroadcastFrame
+from event_coalescer import EventCoalescer
+from job_storage import JobStorage
+from job_ingest import JobIngest
+from construct_auth import ConstructAuth
+from adaptive_timer import AdaptiveTimer
+from async_printer import async_printer
+from raw_pipeline import RawPipeline
+from progress_throttle import ProgressThrottle
+from sensor_history import SensorHistory
+from journal import Journal
+from construct_logging import get_logger, configure_logging
 # Routes
 from construct_socket_handler import ConstructSocketHandler
 from construct_job_upload_handler import ConstructJobUploadHandler
 
+log = get_logger("server")
+
+def register_dns_sd(port):
+  return pybonjour.DNSServiceRegister(name = None,
+                                      regtype = '_construct._tcp',
+                                      port = port,
+                                      domain = "local.")
+
+def on_ioloop(method):
+  # Server methods printer drivers call back into are run on the IOLoop when
+  # called from another thread (drivers run on the printer's thread by
+  # default), the call returns straight away.
+  @functools.wraps(method)
+  def wrapper(self, *args, **kwargs):
+    ident = self._ioloop_thread
+    if ident == None or ident == thread.get_ident():
+      return method(self, *args, **kwargs)
+    self.ioloop.add_callback(method, self, *args, **kwargs)
+  return wrapper
+
 class ConstructServer(tornado.web.Application, EventEmitter):
   def __init__(self, **kwargs):
     self.printer = kwargs["printer"]
+    # A ConstructHost shares its port, routes, upload storage, job ingest and
+    # auth with each of its printers' servers
+    self.host = kwargs.get("host")
     EventEmitter.__init__(self)
 
     # Configuring the Web Server
     if not kwargs["routes"]: kwargs["routes"] = []
-    routes = kwargs["routes"] + [
+    routes = kwargs["routes"]
+    if self.host == None: routes = routes + [
       (r"/socket", ConstructSocketHandler),
       (r"/jobs", ConstructJobUploadHandler),
     ]
     server_settings = kwargs["server_settings"]
     if server_settings == None: server_settings = {}
+    if self.host == None: configure_logging(server_settings)
+    self.port = server_settings.get("port", 8888)
     self.clients = {}
+    self.pending_events = EventCoalescer()
+    self._batch_depth = 0
+    self._flush_scheduled = False
+    self.revision = 0
+    # Identifies this process' history of revisions, which restart at 0
+    self.epoch = uuid.uuid4().hex
+    self.generation = 0
+    self._snapshot = None
+    self._snapshot_generation = None
+    self.change_log = collections.deque()
+    self.change_log_size = server_settings.get("change_log_size", 1000)
+    self._change_log_events = 0
     self.ioloop = tornado.ioloop.IOLoop.instance()
-    signal.signal(signal.SIGINT, self.sigint_handler)
+    # Known once the IOLoop runs, until then every call is made on its thread
+    self._ioloop_thread = None
+    self.ioloop.add_callback(self._record_ioloop_thread)
+    # Printer driver calls are run on a thread of their own and return
+    # futures unless the driver never blocks
+    self.async_printer = async_printer(self.printer, self.ioloop,
+      threaded= server_settings.get("threaded_printer", True)
+    )
+    # Raw blocks keep up to raw_window lines queued for the printer
+    self.raw_pipeline = RawPipeline(self.async_printer, self.ioloop,
+      window= server_settings.get("raw_window", 16),
+      can_send= lambda: self.components['status'] == "idle"
+    )
+    if self.host == None: signal.signal(signal.SIGINT, self.sigint_handler)
     tornado.web.Application.__init__(self, routes, **server_settings)
 
-    # Configuring the print job queue
+    # Configuring the print job queue. Journaled job bodies keep their line
+    # index alongside them.
+    journal_dir = server_settings.get("journal_dir")
+    self.journal = None
+    if self.host != None:
+      self.auth = self.host.auth
+      self.job_storage = self.host.job_storage
+      self.job_ingest = self.host.job_ingest
+    else:
+      self.auth = ConstructAuth(server_settings)
+      self.job_storage = JobStorage(server_settings.get("upload_dir"),
+        sidecars= journal_dir != None
+      )
+      self.job_ingest = JobIngest(self.job_storage, self.ioloop,
+        processes= server_settings.get("ingest_processes"),
+        cache_size= server_settings.get("analysis_cache_size", 256),
+        threads= server_settings.get("ingest_threads", 4)
+      )
     self.jobs = PrintJobQueue(self)
     self.jobs.listeners.add(self)
+    self.listeners.add(self.jobs)
 
     # Configuring the printer components
     self.components = dict(
       motors = dict(enabled = False),
-      jobs = dict(),
+      jobs = self.jobs.by_id,
       pause_between_prints = True,
       sensor_poll_rate = 3000,
       sessions_count = 0,
@@ -50,6 +132,37 @@ class ConstructServer(tornado.web.Application, EventEmitter):
     self.reset_timeout = 0
     self.blockers = []
 
+    # Sensor polling speeds up while heating and backs off when nobody is
+    # watching (rates in ms, like sensor_poll_rate)
+    self.sensor_poll_fast_rate = server_settings.get("sensor_poll_fast_rate", 1000)
+    self.sensor_poll_idle_rate = server_settings.get("sensor_poll_idle_rate", 15000)
+    self.sensor_stable_range = server_settings.get("sensor_stable_range", 2)
+    self.sensor_poller = AdaptiveTimer(self.poll_temp, self.ioloop)
+    for event in [
+      "temp_target_temp_change", "sensor_poll_rate_change",
+      "sessions_count_change", "status_change"
+    ]:
+      self.on(event, lambda *args: self.sensor_poller.poke())
+
+    # Recording each temperature sensor's readings and targets
+    history_size = server_settings.get("sensor_history_size", 3600)
+    self.sensor_history = {}
+    for k, c in self.components.iteritems():
+      if type(c) != dict or c.get('type') != "temp": continue
+      self.sensor_history[k] = SensorHistory(history_size)
+    self.on("temp_current_temp_change", self.record_temp)
+    self.on("temp_target_temp_change", self.record_temp)
+
+    # Restoring the job queue and journaled components after a restart
+    self.journaled_components = server_settings.get("journal_components",
+      ["pause_between_prints", "sensor_poll_rate"]
+    )
+    if journal_dir != None: self.restore_journal(Journal(journal_dir,
+      self.journal_snapshot,
+      compact_size= server_settings.get("journal_compact_size", 1000),
+      fsync= server_settings.get("journal_fsync", False)
+    ))
+
   component_defaults = dict(
     temp = dict(
       current_temp = -1,
@@ -63,58 +176,118 @@ class ConstructServer(tornado.web.Application, EventEmitter):
   )
 
   def start(self):
-    _do = lambda *args: tornado.ioloop.PeriodicCallback(*args).start()
     # Start the print queue and sensor polling
-    _do(self.jobs.iterate_print_job_loop, 300, self.ioloop)
-    _do(self.poll_temp, self.components['sensor_poll_rate'], self.ioloop)
+    self.jobs.start()
+    self.sensor_poller.start()
+    # Hosted printers are served by their host
+    if self.host != None: return
     # Initialize DNS-SD once the server is ready to go online
     self.init_dns_sd()
     # Start the server
-    self.listen(8888)
+    self.listen(self.port)
 
   def init_dns_sd(self):
-    sdRef = pybonjour.DNSServiceRegister(name = None,
-                                         regtype = '_construct._tcp',
-                                         port = 8888,
-                                         domain = "local.")
+    sdRef = register_dns_sd(self.port)
     atexit.register(self.cleanup_service, sdRef)
 
+  def restore_journal(self, journal):
+    self.journal = journal
+    records = journal.load()
+    for record in records:
+      if record['op'] != "set": continue
+      path = record['path']
+      try:
+        self.find_parent(path)[path[-1]] = record['value']
+      except Exception:
+        log.warning("Ignoring the journaled %s, it no longer exists", path)
+    self.jobs.restore(records)
+    # Appending to a damaged journal would follow a partial record
+    if journal.damaged: journal.compact()
+
+  def journal_snapshot(self):
+    records = self.jobs.journal_records()
+    for key in self.journaled_components:
+      if not key in self.components: continue
+      records.append(dict(op= "set", path= [key], value= self.components[key]))
+    return records
+
   def cleanup_service(self, sdRef):
     sdRef.close()
 
   def sigint_handler(self, signum, frame):
-    print "exiting..."
+    log.info("exiting...")
     self.ioloop.stop()
     raise Exception("Ctrl+C")
 
   def poll_temp(self):
+    # Returns the seconds until the next poll
+    interval = self.sensor_poll_interval() / 1000.0
     # A number of conditions that must be met for us to send a temperature 
     # request to the printer. This safeguards this printer from being overloaded
     # by temperature requests it cannot presently respond to.
     c = (not self.sensor_update_received) or (time.time() < self.reset_timeout)
-    if c or len(self.blockers) > 0: return
+    if c or len(self.blockers) > 0: return interval
     # Requesting a temperature update from the printer
     self.sensor_update_received = False
-    self.printer.request_sensor_update()
+    future = self.async_printer.call("request_sensor_update")
+    self.ioloop.add_future(future, self._on_sensor_update_requested)
+    return interval
+
+  def _on_sensor_update_requested(self, future):
+    if future.exception() == None: return
+    # No update is coming, polling resumes with the next request
+    log.warning("request_sensor_update failed", exc_info= future.exc_info())
+    self.sensor_update_received = True
 
+  def sensor_poll_interval(self):
+    # Fast while a heater is working towards its target, the configured
+    # sensor_poll_rate while anyone is watching or printing and slow otherwise.
+    rate = self.components['sensor_poll_rate']
+    if self.is_heating(): return min(rate, self.sensor_poll_fast_rate)
+    if len(self.clients) == 0 and self.components['status'] != "printing":
+      return max(rate, self.sensor_poll_idle_rate)
+    return rate
+
+  def is_heating(self):
+    for c in self.components.itervalues():
+      if type(c) != dict or c.get('type') != "temp": continue
+      if c['target_temp_countdown'] != None or c['blocking']: return True
+      off_target = abs(c['current_temp'] - c['target_temp'])
+      if c['target_temp'] > 0 and off_target > self.sensor_stable_range:
+        return True
+    return False
+
+  def _record_ioloop_thread(self):
+    self._ioloop_thread = thread.get_ident()
+
+  @on_ioloop
   def set_blocking_temps(self, keys):
     unblocked = [k for k in self.blockers if k not in keys]
-    for k in unblocked: self.update_c([k], False)
-    for k in keys: self.update_c([k], True)
+    with self.batch():
+      for k in unblocked: self.c_set([k, 'blocking'], False)
+      for k in keys: self.c_set([k, 'blocking'], True)
     self.blockers = keys
 
+  def record_temp(self, parent_path, value, data):
+    c = self.components[parent_path[0]]
+    history = self.sensor_history[parent_path[0]]
+    history.record(time.time(), c['current_temp'], c['target_temp'])
+
+  @on_ioloop
   def set_sensor_update_received(self, value):
     self.sensor_update_received = value
 
-  # Not thread safe
+  @on_ioloop
   def set_reset_timeout(self, timeout):
     self.reset_timeout = timeout
     self.ioloop.add_timeout(timeout, lambda: self.c_set(['status'], 'idle'))
 
+  @on_ioloop
   def c_add(self, target_path, data, internal= False):
     if 'type' in data: self.fire("add_%s"%data['type'], data, target_path)
     self.c_set(target_path, data, internal=internal, event="add")
 
+  @on_ioloop
   def c_set(self, target_path, data, internal= False, event="change"):
     parent = self.find_parent(target_path, requireKey=(event!="add"))
     key = target_path[-1]
@@ -123,27 +296,42 @@ class ConstructServer(tornado.web.Application, EventEmitter):
     if (key in parent) and parent[key] == data: return
     # do not override virtual attributes. Just skip to firing the event.
     if not virtual: parent[key] = data
+    if self.journal != None and target_path[0] in self.journaled_components:
+      self.journal.append(dict(op= "set", path= target_path, value= data))
+    if not target_path[0] in self.session_components: self.generation += 1
     if internal == False:
       # targets without a parent type are fired internally as "my_key_change"
       event_name = "%s_%s"%(key, event)
       # targets with a parent type are fired internally as "type_my_key_change"
       if 'type' in parent:
-        event_name = "%s_%s"(parent['type'], event_name)
+        event_name = "%s_%s"%(parent['type'], event_name)
       self.fire(event_name, target_path[:-1], parent[key], data)
-    # Sending the event to all the websocket sessions
-    self.broadcast([dict(type= event, data= data, target= target_path)])
+    # Queuing the event for all the websocket sessions
+    self.queue_event(dict(
+      type= event,
+      data= self.public_data(data),
+      target= target_path
+    ))
 
   def c_get(self, target_path):
     target_parent = self.find_parent(target_path, requireKey=True)
     return target_parent[target_path.pop()]
 
+  @on_ioloop
   def c_rm(self, target_path):
     target_parent = self.find_parent(target_path, requireKey=True)
-    key = target_path.pop()
+    key = target_path[-1]
     data = target_parent[key]
-    if 'type' in data: self.fire("rm_%s"%data['type'], data, target_path)
+    if 'type' in data: self.fire("rm_%s"%data['type'], data, target_path[:-1])
     del target_parent[key]
-    self.broadcast([dict(type= "remove", target= target_path)])
+    self.generation += 1
+    self.queue_event(dict(type= "remove", target= target_path))
+
+  def public_data(self, data):
+    # Jobs are sent without their body (a file on the server)
+    if type(data) == dict and data.get('type') == "job":
+      return self.jobs.sanitize(data)
+    return data
 
   def find_parent(self, path, requireKey=True):
     parent = self.components
@@ -154,18 +342,108 @@ class ConstructServer(tornado.web.Application, EventEmitter):
     return parent
 
 
-  def build_initialized_event(self, client):
+  # Components that change with every session (re)connecting. They are sent
+  # alongside the session's own data rather than in the cached snapshot.
+  session_components = ['sessions_count']
+
+  def build_snapshot(self):
     # Adding each component to the data (except jobs, it needs to be modified)
-    data = {k:v for k,v in self.components.iteritems() if not k in ['jobs']}
-    # Adding the jobs (minus their full text) and this sessions's uuid
-    data = dict(data, **dict(
-      session_uuid= client.session_uuid,
-      jobs= self.jobs.public_list()
-    ))
+    excluded = ['jobs'] + self.session_components
+    data = {k:v for k,v in self.components.iteritems() if not k in excluded}
+    # Adding the jobs (minus their full text)
+    data['jobs'] = self.jobs.public_list()
+    return data
+
+  def build_session_data(self, client):
+    data = {k: self.components[k] for k in self.session_components}
+    data.update(session_uuid= client.session_uuid, revision= self.revision,
+      epoch= self.epoch
+    )
+    token = getattr(client, "session_token", None)
+    if token != None: data['session_token'] = token
+    return data
+
+  def build_initialized_event(self, client):
+    data = dict(self.build_snapshot(), **self.build_session_data(client))
     return [dict(type= "initialized", data= data)]
 
+  def initialized_frame(self, client):
+    # The snapshot is only serialized once per generation of the component
+    # tree. Each session's own fields are spliced in front of it.
+    if self._snapshot_generation != self.generation:
+      self._snapshot = json.dumps(self.build_snapshot())
+      self._snapshot_generation = self.generation
+    session = json.dumps(self.build_session_data(client))
+    payload = '[{"type": "initialized", "data": %s, %s}]'%(
+      session[:-1], self._snapshot[1:]
+    )
+    return BroadcastFrame(None, payload= payload)
+
+  def build_resumed_events(self, client, revision, epoch):
+    # The events a client missed since the revision it last saw or None if
+    # they are no longer in the change log, or the revision is from another
+    # process' history, and it needs a full snapshot.
+    if epoch != self.epoch: return None
+    events = self.events_since(revision)
+    if events == None: return None
+    data = dict(session_uuid= client.session_uuid, revision= self.revision,
+      epoch= self.epoch
+    )
+    return [dict(type= "resumed", data= data)] + events
+
+  def events_since(self, revision):
+    if revision > self.revision: return None
+    if revision == self.revision: return []
+    if len(self.change_log) == 0 or self.change_log[0][0] > revision + 1:
+      return None
+    missed = EventCoalescer()
+    for r, events in self.change_log:
+      if r <= revision: continue
+      for event in events: missed.push(event)
+    return missed.events()
+
+  def log_changes(self, events):
+    # Every flush is a new revision of the component tree. A bounded number
+    # of events is kept for resuming sessions.
+    self.revision += 1
+    for event in events: event['revision'] = self.revision
+    self.change_log.append((self.revision, events))
+    self._change_log_events += len(events)
+    while self._change_log_events > self.change_log_size:
+      self._change_log_events -= len(self.change_log.popleft()[1])
+
+  @contextlib.contextmanager
+  def batch(self):
+    # Groups several c_set/c_add/c_rm calls into a single broadcast sent when
+    # the outermost batch exits. Nested batches are merged into their parent.
+    self._batch_depth += 1
+    try:
+      yield
+    finally:
+      self._batch_depth -= 1
+      if self._batch_depth == 0: self.flush_events()
+
+  def queue_event(self, event):
+    # Events are coalesced (last write wins per target path) and flushed once
+    # per IOLoop tick.
+    self.pending_events.push(event)
+    if self._batch_depth > 0 or self._flush_scheduled: return
+    self._flush_scheduled = True
+    self.ioloop.add_callback(self.flush_events)
+
+  def flush_events(self):
+    self._flush_scheduled = False
+    if self._batch_depth > 0 or len(self.pending_events) == 0: return
+    events = self.pending_events.events()
+    self.pending_events.clear()
+    self.log_changes(events)
+    self.broadcast(events)
+
   def broadcast(self, events):
-    for id, client in self.clients.iteritems(): client.send(events)
+    if len(self.clients) == 0: return
+    # Encoded once and shared by every session
+    frame = BroadcastFrame(events)
+    for client in self.clients.itervalues(): client.send_frame(frame)
 
   def add_client(self, client):
     self.c_set(['sessions_count'], len(self.clients))
@@ -178,20 +456,40 @@ class ConstructServer(tornado.web.Application, EventEmitter):
   # Commands
   # --------------------------------------------------------------------------
 
-  def run_cmd(self, c):
+  def run_cmd(self, c, session= None):
     status = self.c_get(['status'])
-    if status != "idle" and (c.cmd != "estop" and c.cmd.find("job") == -1):
+    # Queries, job changes and estops are allowed while printing
+    allowed = c.cmd == "estop" or c.cmd.find("job") != -1 or c.cmd.startswith("get_")
+    if status != "idle" and not allowed:
       raise Exception("Cannot run commands when %s"%status)
+    # Raw blocks report their progress to the session that sent them
+    if c.cmd == "raw_block": return self.send_raw_block(c.args, session)
     for d in [self.printer, self.jobs, self]:
       if hasattr(d, c.method_name): delegate = d
+    # Printer commands return a future, they are acked once it resolves
+    if delegate is self.printer:
+      return self.async_printer.call(c.method_name, *(c.args), **(c.kwargs))
     return getattr(delegate, c.method_name)(*(c.args), **(c.kwargs))
 
+  def send_raw_block(self, lines, session= None):
+    progress = ProgressThrottle(len(lines),
+      interval= self.settings.get("raw_progress_interval", 0.5),
+      step= self.settings.get("raw_progress_step", 1.0)
+    )
+    def on_progress(sent, total):
+      if session == None or not progress.ready(sent): return
+      data = dict(sent = sent, total = total)
+      target = ['session', 'raw_block_progress']
+      session.send([dict(type = 'change', target = target, data = data)])
+    return self.raw_pipeline.send(lines, on_progress)
+
   def do_set(self, *args, **kwargs):
-    if(len(args) == 1 and args[0] == "temp"):
-      key = "target_temp"
-      for target, data in kwargs.iteritems(): self.c_set([target, key], data)
-    else:
-      for k, v in kwargs.iteritems(): self.set_speed_or_enabled(k, v)
+    with self.batch():
+      if(len(args) == 1 and args[0] == "temp"):
+        key = "target_temp"
+        for target, data in kwargs.iteritems(): self.c_set([target, key], data)
+      else:
+        for k, v in kwargs.iteritems(): self.set_speed_or_enabled(k, v)
 
   def set_speed_or_enabled(self, k, v):
     if (type(v) == bool):         key = "enabled"
@@ -201,24 +499,53 @@ class ConstructServer(tornado.web.Application, EventEmitter):
     if k == "conveyor": target = "c0"
     self.c_set([target, key], v)
 
-  def do_change_job(self, *kwargs):
+  def do_change_job(self, **kwargs):
     job_id = kwargs['id']
     del kwargs['id']
-    for k, v in kwargs.iteritems(): self.c_set(['jobs', job_id, k], v)
-
+    with self.batch():
+      for k, v in kwargs.iteritems(): self.c_set(['jobs', job_id, k], v)
+
+  def do_get_sessions(self):
+    # Outbound queue depth per session, for finding slow consumers
+    sessions = [c.queue_stats() for c in self.clients.itervalues()]
+    return dict(sessions= sessions)
+
+  def do_get_temp_history(self, *sensors, **kwargs):
+    # since and until are unix timestamps or, if not positive, seconds
+    # relative to now
+    now = time.time()
+    since, until = [kwargs.get(k, d) for k, d in [('since', -600), ('until', 0)]]
+    if since <= 0: since += now
+    if until <= 0: until += now
+    points = kwargs.get('points', 60)
+    if len(sensors) == 0: sensors = sorted(self.sensor_history)
+    for k in sensors:
+      if not k in self.sensor_history: raise Exception("%s has no history"%k)
+    history = {k: self.sensor_history[k].downsample(since, until, points)
+      for k in sensors}
+    return dict(temp_history= history)
+
+  @tornado.gen.coroutine
   def do_print(self):
-    if not self.printer.is_online(): raise Exception("Not online")
+    online = yield self.async_printer.call("is_online")
+    if not online: raise Exception("Not online")
     no_jobs_msg = "Nothing to print. Try adding a print job with add_job."
-    if len(self.jobs.list) == 0: raise Exception(no_jobs_msg)
+    if len(self.jobs.order) == 0: raise Exception(no_jobs_msg)
     self.c_set(['status'], 'printing')
 
   def do_estop(self):
-    self.printer.do_estop()
-    self.c_set(['status'], 'estopped')
-    # Resetting all the printer's attributes
-    for target, attrs in self.components.iteritems():
-      if type(attrs) != dict: continue
-      if not ("type" in attrs and attrs["type"] in self.component_defaults):
-        continue
-      for key, data in self.component_defaults[attrs["type"]].iteritems():
-        self.c_set([target, key], data, internal = True)
+    # Jumps ahead of (and cancels) any queued printer calls
+    future = self.async_printer.call("do_estop")
+    # Streaming printers stop receiving the job's lines and raw blocks
+    self.jobs.close_reader()
+    self.raw_pipeline.cancel("Cancelled by an estop")
+    with self.batch():
+      self.c_set(['status'], 'estopped')
+      # Resetting all the printer's attributes
+      for target, attrs in self.components.iteritems():
+        if type(attrs) != dict: continue
+        if not ("type" in attrs and attrs["type"] in self.component_defaults):
+          continue
+        for key, data in self.component_defaults[attrs["type"]].iteritems():
+          self.c_set([target, key], data, internal = True)
+    return future
@@ -1,13 +1,38 @@
-import json, uuid, re, time, traceback, tornado, tornado.websocket
-from pprint import pprint
+import uuid, re, time, tornado, tornado.websocket, tornado.concurrent
 from construct_auth import construct_socket_auth
 from construct_cmd_parser import ConstructCmdParser
+from broadcast_frame import BroadcastFrame
+from outbound_queue import OutboundQueue
+import construct_binary
+from construct_deflate import negotiate_deflate, is_websocket_upgrade, \
+  DeflateWebSocketProtocol
+from construct_logging import get_logger
+
+log = get_logger("socket")
+message_log = get_logger("socket.messages")
 
 CONSTRUCT_PROTOCOL_VERSION = [0,3,0]
 
 class ConstructSocketHandler(tornado.websocket.WebSocketHandler):
   clients = []
 
+  def initialize(self, server= None):
+    # The ConstructServer of the printer this socket is for, a host's
+    # printers each have their own
+    self.server = server or self.application
+    settings = self.server.settings
+    self.outbound = OutboundQueue(
+      settings.get("client_queue_max_bytes", 1024 * 1024),
+      settings.get("client_queue_max_frames", 1000)
+    )
+    self.slow_consumer_policy = settings.get("slow_consumer_policy", "resync")
+    self.resync_frame = None
+    self.resyncs = 0
+    self.encoding = "text"
+    self.deflate = None
+    self.session_token = None
+    self.session_uuid = None
+
   def on_sensor_changed(self):
     for name in ['bed', 'extruder']:
       self.send(
@@ -22,8 +47,29 @@ class ConstructSocketHandler(tornado.websocket.WebSocketHandler):
     self.send({event_name: data})
 
   def _execute(self, transforms, *args, **kwargs):
-    self.authorized = construct_socket_auth(self)
-    super(ConstructSocketHandler, self)._execute(transforms, *args, **kwargs)
+    # Verifying a password can take a trip to a worker thread
+    construct_socket_auth(self,
+      lambda user_info: self._accept(user_info, transforms, *args, **kwargs)
+    )
+
+  def _accept(self, user_info, transforms, *args, **kwargs):
+    if self.stream.closed(): return
+    self.authorized = user_info
+    # Reconnecting with the session token skips the password check
+    if user_info:
+      self.session_token = self.server.auth.issue_token(user_info)
+    offers = self.request.headers.get("Sec-WebSocket-Extensions")
+    deflate = negotiate_deflate(offers, self.server.settings)
+    if deflate == None or not is_websocket_upgrade(self.request):
+      return super(ConstructSocketHandler, self)._execute(
+        transforms, *args, **kwargs
+      )
+    # Accepting the connection with permessage-deflate
+    self.open_args = args
+    self.open_kwargs = kwargs
+    self.deflate = deflate
+    self.ws_connection = DeflateWebSocketProtocol(self, deflate)
+    self.ws_connection.accept_connection()
 
   def select_subprotocol(self, subprotocols):
     # Chooses a compatible construct protocol from the list sent by the 
@@ -35,29 +81,34 @@ class ConstructSocketHandler(tornado.websocket.WebSocketHandler):
     # Version 0 protocols are unstable and can break compatibility more often.
     # We are only going to cause backwards incompatibility in 0.x minor version
     # See http://semver.org/
+    # The text (JSON) and binary (MessagePack) encodings follow the same
+    # versioning. Between equal versions the client's first choice is used.
     server_v = CONSTRUCT_PROTOCOL_VERSION
     compatible_v = [-1, -1]
     for p in list(subprotocols):
-      regex = '^construct\.text\.([0-9]+)\.?([0-9]+)'
-      client_v = [int(s) for s in list(re.search(regex, p).groups())]
-      pprint(client_v)
+      match = self._protocol_regex.search(p)
+      if match == None: continue
+      client_v = [int(s) for s in match.groups()[1:]]
       if client_v[0] == server_v[0] and client_v[1] <= server_v[1]:
-        if client_v[1] > compatible_v[1]: compatible_v = client_v
+        if client_v[1] > compatible_v[1]:
+          compatible_v = client_v
+          selected = p
+          self.encoding = match.group(1)
 
-    print subprotocols
-    print compatible_v
+    log.debug("client subprotocols: %s, compatible version: %s",
+      subprotocols, compatible_v)
 
     # On incompatibility: Return a BS version and sending an error once the 
     # connection opens.
     self.client_versions = subprotocols
     self.compatible = compatible_v[1] > -1
-    pprint(self.compatible)
-    print self._protocol_str(compatible_v)
     if not self.compatible: return subprotocols[0]
-    return self._protocol_str(compatible_v)
+    return selected
+
+  _protocol_regex = re.compile('^construct\.(text|binary)\.([0-9]+)\.?([0-9]+)')
 
   def _protocol_str(self, v):
-    return "construct.text.%i.%i"%(v[0], v[1])
+    return "construct.%s.%i.%i"%(self.encoding, v[0], v[1])
 
   def open(self):
     if not self.authorized:
@@ -78,37 +129,116 @@ class ConstructSocketHandler(tornado.websocket.WebSocketHandler):
     if not (self.authorized and self.compatible): return self.stream.close()
 
     self.session_uuid = str(uuid.uuid4())
-    self.application.add_client(self)
-    self.send( self.application.build_initialized_event(self) )
-
-    open_clients = len(self.application.clients)
-    print "WebSocket opened. %i sockets currently open." % open_clients
+    self.server.add_client(self)
+    # Reconnecting sessions only receive the events they missed when possible
+    events = None
+    revision = self.get_argument("revision", None)
+    epoch = self.get_argument("epoch", None)
+    if revision != None and revision.isdigit() and epoch != None:
+      events = self.server.build_resumed_events(self, int(revision), epoch)
+    if events != None: self.send(events)
+    else: self.send_frame(self.server.initialized_frame(self))
+
+    open_clients = len(self.server.clients)
+    log.info("WebSocket opened. %i sockets currently open.", open_clients)
 
   def on_message(self, msg):
     if not self.authorized: return
+    message_log.debug("message received: %r", msg)
     # Parsing the command
     try:
-      cmd = ConstructCmdParser(msg)
+      # Binary frames contain a MessagePack encoded command string
+      if isinstance(msg, str): msg = construct_binary.unpack(msg)
+      cmd = ConstructCmdParser.parse(msg)
     except Exception as ex:
-      print traceback.format_exc()
+      log.debug("invalid command %r", msg, exc_info= True)
       return self._error(message= str(ex), type= 'syntax.sync')
     # Running the command
     try:
-      self.send([{"type": "ack", "data": self.application.run_cmd(cmd)}])
+      data = self.server.run_cmd(cmd, session= self)
     except Exception as ex:
-      print traceback.format_exc()
-      self._error(message= str(ex), type= 'runtime.sync')
+      return self._cmd_failed(cmd, ex)
+    # Commands run by the printer are acked once their future resolves
+    if isinstance(data, tornado.concurrent.Future):
+      return self.server.ioloop.add_future(data,
+        lambda future: self._cmd_done(cmd, future)
+      )
+    self._ack(data)
+
+  def _cmd_done(self, cmd, future):
+    try:
+      data = future.result()
+    except Exception as ex:
+      return self._cmd_failed(cmd, ex)
+    self._ack(data)
+
+  def _cmd_failed(self, cmd, ex):
+    log.warning("%s failed", cmd.cmd, exc_info= True)
+    self.server.flush_events()
+    self._error(message= str(ex), type= 'runtime.sync')
+
+  def _ack(self, data):
+    # The ack is sent after the changes the command made
+    self.server.flush_events()
+    self.send([{"type": "ack", "data": data}])
 
   def _error(self, **kwargs):
     self.send([{"type": "error", "data": kwargs}])
 
   def send(self, message):
-    print "sending:"
-    print message
-    self.write_message(json.dumps(message))
+    self.send_frame(BroadcastFrame(message))
+
+  def send_frame(self, frame):
+    ws = self.ws_connection
+    if ws == None or ws.stream.closed(): return
+    if not isinstance(ws, tornado.websocket.WebSocketProtocol13):
+      return self.write_message(frame.payload)
+    # Frames are queued while the socket is still writing previous ones
+    if len(self.outbound) == 0 and not ws.stream.writing():
+      return self._write_frame(frame)
+    self.outbound.push(frame)
+    if self.outbound.over_limit(): self._on_queue_full()
+    self._drain()
+
+  def _write_frame(self, frame):
+    # Writing the pre-built frame skips re-framing the payload per session
+    if self.deflate == None: data = frame.wire(self.encoding)
+    else: data = self.deflate.wire(frame, self.encoding)
+    self.ws_connection.stream.write(data, self._drain)
+
+  def _drain(self):
+    ws = self.ws_connection
+    if ws == None or ws.stream.closed(): return
+    while len(self.outbound) > 0 and not ws.stream.writing():
+      frame = self.outbound.popleft()
+      if frame is self.resync_frame: self.resync_frame = None
+      self._write_frame(frame)
+
+  def _on_queue_full(self):
+    self.outbound.coalesce()
+    if not self.outbound.over_limit(): return
+    # The session still can't keep up. It either gets a fresh snapshot in
+    # place of its queued tree events or, if it hasn't even received the
+    # last one, it is dropped.
+    if self.slow_consumer_policy == "resync" and self.resync_frame == None:
+      self.resyncs += 1
+      self.resync_frame = self.server.initialized_frame(self)
+      self.outbound.resync(self.resync_frame)
+    else:
+      log.warning("Dropping slow WebSocket session %s", self.session_uuid)
+      self.outbound.clear()
+      self.close()
+
+  def queue_stats(self):
+    return dict(
+      session_uuid= self.session_uuid,
+      queued_frames= len(self.outbound),
+      queued_bytes= self.outbound.bytes,
+      resyncs= self.resyncs
+    )
 
   def on_close(self):
-    if self.session_uuid in self.application.clients:
-      self.application.remove_client(self)
-    open_clients = len(self.application.clients)
-    print "WebSocket closed. %i sockets currently open." % open_clients
+    if self.session_uuid in self.server.clients:
+      self.server.remove_client(self)
+    open_clients = len(self.server.clients)
+    log.info("WebSocket closed. %i sockets currently open.", open_clients)
@@ -0,0 +1,41 @@
+from collections import OrderedDict
+
+class EventCoalescer(object):
+  # Merges construct events so that only the latest event for each target
+  # path is kept (last write wins). An add, remove or change of a dict/list
+  # replaces its whole subtree so it also supersedes any pending events on the
+  # children of its target. Events without a target are never merged.
+  def __init__(self):
+    self._events = OrderedDict()
+    self._untargeted = 0
+
+  def __len__(self):
+    return len(self._events)
+
+  def push(self, event):
+    if not 'target' in event:
+      self._untargeted += 1
+      self._events[(None, self._untargeted)] = event
+      return
+    path = tuple(event['target'])
+    previous = self._events.pop(path, None)
+    replaces_subtree = event['type'] != "change" or \
+      type(event.get('data')) in [dict, list]
+    if replaces_subtree: self._drop_children(path)
+    # The session never saw the add so the change becomes the add
+    if previous != None and previous['type'] == "add" \
+        and event['type'] == "change":
+      event = dict(event, type= "add")
+    self._events[path] = event
+
+  def _drop_children(self, path):
+    n = len(path)
+    children = [k for k in self._events.iterkeys()
+      if k[0] != None and len(k) > n and k[:n] == path]
+    for k in children: del self._events[k]
+
+  def events(self):
+    return self._events.values()
+
+  def clear(self):
+    self._events.clear()
@@ -1,14 +1,69 @@
+from functools import partial
+
+class ListenerSet(set):
+  # A set of listeners that invalidates its emitter's dispatch cache whenever
+  # it is modified.
+  def __init__(self, emitter):
+    super(ListenerSet, self).__init__()
+    self._emitter = emitter
+
+  def _modified(method):
+    def wrapper(self, *args):
+      result = method(self, *args)
+      self._emitter._invalidate()
+      return result
+    return wrapper
+
+  add = _modified(set.add)
+  remove = _modified(set.remove)
+  discard = _modified(set.discard)
+  clear = _modified(set.clear)
+  update = _modified(set.update)
+  pop = _modified(set.pop)
+  difference_update = _modified(set.difference_update)
+  __ior__ = _modified(set.__ior__)
+  __isub__ = _modified(set.__isub__)
+  del _modified
+
 class EventEmitter(object):
+  # Events are dispatched to listeners' "on_<event_name>" methods (or their
+  # on_uncaught_event fallback) and to callbacks subscribed with on(). The
+  # callbacks for each event name are resolved once and cached until the
+  # listeners or subscriptions change.
   def __init__(self):
-    self.listeners = set()
+    self.listeners = ListenerSet(self)
+    self._subscriptions = {}
+    self._dispatch = {}
+
+  def on(self, event_name, callback):
+    self._subscriptions.setdefault(event_name, []).append(callback)
+    self._dispatch.pop(event_name, None)
+
+  def off(self, event_name, callback):
+    self._subscriptions[event_name].remove(callback)
+    if len(self._subscriptions[event_name]) == 0:
+      del self._subscriptions[event_name]
+    self._dispatch.pop(event_name, None)
 
   def fire(self, event_name, *args):
+    try:
+      callbacks = self._dispatch[event_name]
+    except KeyError:
+      callbacks = self._resolve(event_name)
+    for callback in callbacks: callback(*args)
+
+  def _resolve(self, event_name):
     callback_name = "on_%s" % event_name
+    callbacks = []
     for listener in self.listeners:
-      if hasattr(listener, callback_name):
-        callback = getattr(listener, callback_name)
-        callback(*args)
-      elif hasattr(listener, "on_uncaught_event"):
-        listener.on_uncaught_event(event_name, content)
-      else:
-        continue
+      callback = getattr(listener, callback_name, None)
+      if callback == None:
+        uncaught = getattr(listener, "on_uncaught_event", None)
+        if uncaught != None: callback = partial(uncaught, event_name)
+      if callback != None: callbacks.append(callback)
+    callbacks = tuple(callbacks + self._subscriptions.get(event_name, []))
+    self._dispatch[event_name] = callbacks
+    return callbacks
+
+  def _invalidate(self):
+    self._dispatch.clear()
@@ -0,0 +1,146 @@
+import re, math, hashlib
+
+# Commands are picked out of a whole block of G-code at a time and only their
+# numeric words are parsed, comments and other commands are skipped by the
+# regular expressions rather than line by line in python.
+_command_re = re.compile(r'^[ \t]*(?:N[0-9]+[ \t]*)?([GM])([0-9]+)([^;(\n]*)', re.M)
+_word_re = re.compile(r'([XYZEFPS])[ \t]*([-+]?[0-9]*\.?[0-9]+)')
+
+BLOCK_SIZE = 1024 * 1024
+AXES = "XYZ"
+
+def content_hash(path):
+  sha1 = hashlib.sha1()
+  with open(path, "rb") as f:
+    for block in iter(lambda: f.read(BLOCK_SIZE), ""): sha1.update(block)
+  return sha1.hexdigest()
+
+def blocks(path):
+  # Yields the file in blocks of whole lines
+  rest = ""
+  with open(path, "rb") as f:
+    for block in iter(lambda: f.read(BLOCK_SIZE), ""):
+      block = rest + block
+      end = block.rfind("\n") + 1
+      rest = block[end:]
+      if end > 0: yield block[:end]
+  if rest: yield rest
+
+class GCodeAnalyzer(object):
+  # Streams over a G-code file once, tracking the tool position to measure
+  # the filament used, the bounding box of the extruded moves, the layers
+  # (line numbers where extrusion starts at a new height) and the print time
+  # (moves at their feedrate, ignoring acceleration, plus dwells).
+  def __init__(self):
+    self.position = [0.0, 0.0, 0.0]
+    self.e = 0.0
+    self.feedrate = 1500.0
+    self.absolute = True
+    self.absolute_e = True
+    self.scale = 1.0
+    self.lines = 0
+    self.filament_used = 0.0
+    self.time = 0.0
+    self.low = None
+    self.high = None
+    self.layers = []
+    self._layer_z = None
+    self._z_line = 0
+
+  def feed(self, block):
+    line = self.lines
+    last = 0
+    count = block.count
+    words_re = _word_re.findall
+    move = self._move
+    for match in _command_re.finditer(block):
+      start = match.start()
+      line += count("\n", last, start)
+      last = start
+      letter, number, words = match.groups()
+      words = dict(words_re(words))
+      if letter == "M": self._m(int(number))
+      elif number in ("0", "1", "00", "01"): move(words, line)
+      else: self._g(int(number), words, line)
+    self.lines += count("\n")
+    if not block.endswith("\n"): self.lines += 1
+
+  def _g(self, code, words, line):
+    if code in (0, 1): self._move(words, line)
+    elif code == 4:
+      self.time += float(words.get('P', 0)) / 1000.0 + float(words.get('S', 0))
+    elif code == 20: self.scale = 25.4
+    elif code == 21: self.scale = 1.0
+    elif code == 28:
+      for i, axis in enumerate(AXES):
+        if axis in words or not any(a in words for a in AXES):
+          self.position[i] = 0.0
+    elif code == 90: self.absolute = self.absolute_e = True
+    elif code == 91: self.absolute = self.absolute_e = False
+    elif code == 92:
+      for i, axis in enumerate(AXES):
+        if axis in words: self.position[i] = float(words[axis]) * self.scale
+      if 'E' in words: self.e = float(words['E']) * self.scale
+
+  def _m(self, code):
+    if code == 82: self.absolute_e = True
+    elif code == 83: self.absolute_e = False
+
+  def _move(self, words, line):
+    # The hot path, numeric words are still strings here
+    scale = self.scale
+    x0, y0, z0 = x, y, z = self.position
+    if self.absolute:
+      if 'X' in words: x = float(words['X']) * scale
+      if 'Y' in words: y = float(words['Y']) * scale
+      if 'Z' in words: z = float(words['Z']) * scale
+    else:
+      if 'X' in words: x += float(words['X']) * scale
+      if 'Y' in words: y += float(words['Y']) * scale
+      if 'Z' in words: z += float(words['Z']) * scale
+    self.position = [x, y, z]
+    if z != z0: self._z_line = line
+    extruded = 0.0
+    if 'E' in words:
+      e = float(words['E']) * scale
+      extruded = e - self.e if self.absolute_e else e
+      self.e += extruded
+    if 'F' in words:
+      f = float(words['F']) * scale
+      if f > 0: self.feedrate = f
+    distance = math.sqrt((x - x0) ** 2 + (y - y0) ** 2 + (z - z0) ** 2)
+    if distance == 0: distance = abs(extruded)
+    self.time += distance * 60.0 / self.feedrate
+    if extruded <= 0: return
+    self.filament_used += extruded
+    if self._layer_z == None or z > self._layer_z + 1e-6:
+      self._layer_z = z
+      self.layers.append(self._z_line)
+    low, high = self.low, self.high
+    if low == None:
+      self.low = low = [x0, y0, z0]
+      self.high = high = [x0, y0, z0]
+    low[0] = min(low[0], x0, x)
+    low[1] = min(low[1], y0, y)
+    low[2] = min(low[2], z0, z)
+    high[0] = max(high[0], x0, x)
+    high[1] = max(high[1], y0, y)
+    high[2] = max(high[2], z0, z)
+
+  def results(self):
+    return dict(
+      line_count = self.lines,
+      layers = self.layers,
+      layer_count = len(self.layers),
+      filament_used = round(self.filament_used, 2),
+      bounding_box = None if self.low == None else dict(
+        min = [round(v, 3) for v in self.low],
+        max = [round(v, 3) for v in self.high]
+      ),
+      estimated_time = int(round(self.time))
+    )
+
+def analyze(path):
+  analyzer = GCodeAnalyzer()
+  for block in blocks(path): analyzer.feed(block)
+  return analyzer.results()
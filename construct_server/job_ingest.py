@@ -0,0 +1,152 @@
+import os, mmap, threading, traceback, multiprocessing, Queue
+from array import array
+from collections import OrderedDict
+import tornado.gen
+from tornado.concurrent import TracebackFuture
+from job_storage import JobBody, index_typecode
+from gcode_analyzer import analyze, content_hash
+
+def index_chunk(path, start, end, typecode):
+  # The start offsets of the lines following each newline in [start, end)
+  with open(path, "rb") as f:
+    data = mmap.mmap(f.fileno(), 0, access= mmap.ACCESS_READ)
+    try:
+      offsets = array(typecode)
+      i = data.find("\n", start, end)
+      while i != -1:
+        offsets.append(i + 1)
+        i = data.find("\n", i + 1, end)
+      return offsets
+    finally:
+      data.close()
+
+def _call(fn, *args):
+  # Exceptions don't make it back from a pool worker, tracebacks do
+  try:
+    return True, fn(*args)
+  except Exception:
+    return False, traceback.format_exc()
+
+class JobIngest(object):
+  # Prepares uploaded job bodies without blocking the IOLoop. Post processing
+  # runs on a thread (it is the printer's method) and line indexing is split
+  # into chunk_size chunks indexed in parallel by a process pool while
+  # another of its processes analyzes the G-code. The analysis is CPU bound
+  # python so it always runs in the pool, bodies smaller than a chunk are
+  # cheap to index and are indexed on a thread. Everything runs on threads
+  # if `processes` is 0.
+  # Analyses are cached by content hash so re-uploaded jobs skip them.
+  def __init__(self, storage, ioloop, processes= None,
+      chunk_size= 8 * 1024 * 1024, cache_size= 256, threads= 4):
+    self.storage = storage
+    self.ioloop = ioloop
+    self.processes = processes
+    self.chunk_size = chunk_size
+    self.cache_size = cache_size
+    self.analyses = OrderedDict()
+    self._pool = None
+    # A fixed number of threads run the thread tasks of every ingest
+    self.threads = threads
+    self._tasks = Queue.Queue()
+    self._workers = []
+
+  def _resolve(self, future, result):
+    ok, value = result
+    if ok: future.set_result(value)
+    else: future.set_exception(Exception(value))
+
+  def in_thread(self, fn, *args):
+    # Started on first use like the process pool
+    if len(self._workers) == 0:
+      for i in range(self.threads):
+        worker = threading.Thread(target= self._work, name= "construct-ingest")
+        worker.daemon = True
+        worker.start()
+        self._workers.append(worker)
+    future = TracebackFuture()
+    self._tasks.put((fn, args, future))
+    return future
+
+  def _work(self):
+    while True:
+      fn, args, future = self._tasks.get()
+      if fn == None: return
+      result = _call(fn, *args)
+      self.ioloop.add_callback(self._resolve, future, result)
+
+  def in_process(self, fn, *args):
+    if self.processes == 0: return self.in_thread(fn, *args)
+    # Created on first use so servers that never ingest a job don't fork
+    if self._pool == None: self._pool = multiprocessing.Pool(self.processes)
+    future = TracebackFuture()
+    self._pool.apply_async(_call, (fn,) + args, callback= lambda result:
+      self.ioloop.add_callback(self._resolve, future, result)
+    )
+    return future
+
+  @tornado.gen.coroutine
+  def ingest(self, file_name, body, post_process= None, on_progress= None):
+    # Resolves to the stored and indexed JobBody and its analysis.
+    # on_progress(stage, progress) is called as each stage progresses.
+    original = getattr(body, "name", None)
+    # The paths written so far
+    stored = []
+    try:
+      body = yield self._ingest(file_name, body, post_process, on_progress,
+        stored
+      )
+    except Exception:
+      # Not leaving the spooled upload or the stored body behind
+      for path in [original] + stored:
+        if path != None and os.path.exists(path): os.remove(path)
+      raise
+    raise tornado.gen.Return(body)
+
+  @tornado.gen.coroutine
+  def _ingest(self, file_name, body, post_process, on_progress, stored):
+    progress = on_progress or (lambda stage, progress: None)
+    original = getattr(body, "name", None)
+    if post_process != None:
+      progress("post_processing", 0.0)
+      body = yield self.in_thread(post_process, file_name, body)
+      progress("post_processing", 1.0)
+    path = yield self.in_thread(self.storage.write, file_name, body)
+    stored.append(path)
+    # Removing the upload's spool file if post processing replaced it
+    if original != None and original != path and os.path.exists(original):
+      os.remove(original)
+    progress("indexing", 0.0)
+    size = os.path.getsize(path)
+    step = self.chunk_size
+    run = self.in_process if size > step else self.in_thread
+    digest = yield self.in_thread(content_hash, path)
+    analysis = self.analyses.pop(digest, None)
+    if analysis == None: analysis_future = self.in_process(analyze, path)
+    typecode = index_typecode(size)
+    chunks = [(path, start, min(start + step, size), typecode)
+      for start in xrange(0, size, step)]
+    futures = [run(index_chunk, *chunk) for chunk in chunks]
+    offsets = array(typecode, [0])
+    for i, future in enumerate(futures):
+      offsets.extend((yield future))
+      progress("indexing", float(i + 1) / len(futures))
+    if offsets[-1] != size: offsets.append(size)
+    body = JobBody(path, offsets)
+    if analysis == None:
+      progress("analyzing", 0.0)
+      try:
+        analysis = yield analysis_future
+      except Exception:
+        body.close()
+        raise
+      analysis['content_hash'] = digest
+      progress("analyzing", 1.0)
+    stored.append(body.index_path)
+    yield self.in_thread(self.storage.save_index, body)
+    if len(self.analyses) >= self.cache_size: self.analyses.popitem(last= False)
+    self.analyses[digest] = analysis
+    raise tornado.gen.Return((body, analysis))
+
+  def close(self):
+    if self._pool != None: self._pool.terminate()
+    for worker in self._workers: self._tasks.put((None, None, None))
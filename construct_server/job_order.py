@@ -0,0 +1,104 @@
+from bisect import bisect_left
+
+INFINITY = float("inf")
+
+class JobOrder(object):
+  # The print order of the queued job ids. Jobs are sorted by priority
+  # (highest first), then deadline (earliest first, None last) and then a
+  # rank that preserves insertion order and manual reordering.
+  #
+  # Sort keys are kept in a sorted list searched with bisect and each id's
+  # key in a dict so lookups, positions, insertion and removal by id never
+  # scan or compare whole jobs.
+  def __init__(self):
+    self._entries = []
+    self._keys = {}
+    self._next_rank = 0.0
+    # Counts renumberings, which change the rank of every job
+    self.renumbers = 0
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __contains__(self, job_id):
+    return job_id in self._keys
+
+  def __iter__(self):
+    return (job_id for key, job_id in self._entries)
+
+  def _insert(self, job_id, key):
+    entry = (key, job_id)
+    self._entries.insert(bisect_left(self._entries, entry), entry)
+    self._keys[job_id] = key
+
+  def add(self, job_id, priority= 0, deadline= None, rank= None):
+    # Jobs are added last among their equals unless given a rank (restoring
+    # a job's place in the order)
+    if rank == None: rank = self._next_rank + 1
+    self._next_rank = max(self._next_rank, rank)
+    self._insert(job_id, self._key(priority, deadline, rank))
+
+  def _key(self, priority, deadline, rank):
+    return (-priority, INFINITY if deadline == None else deadline, rank)
+
+  def remove(self, job_id):
+    entry = (self._keys.pop(job_id), job_id)
+    del self._entries[bisect_left(self._entries, entry)]
+
+  def position(self, job_id):
+    return bisect_left(self._entries, (self._keys[job_id], job_id))
+
+  def schedule(self, job_id):
+    # The (priority, deadline) a job is ordered by
+    key = self._keys[job_id]
+    return (-key[0], None if key[1] == INFINITY else key[1])
+
+  def rank(self, job_id):
+    return self._keys[job_id][2]
+
+  def first(self):
+    return self._entries[0][1] if len(self._entries) > 0 else None
+
+  def pop(self, job_id= None):
+    if job_id == None: job_id = self.first()
+    self.remove(job_id)
+    return job_id
+
+  def reschedule(self, job_id, priority= 0, deadline= None):
+    rank = self._keys[job_id][2]
+    self.remove(job_id)
+    self._insert(job_id, self._key(priority, deadline, rank))
+
+  def move(self, job_id, position):
+    self.remove(job_id)
+    self._insert_at(job_id, position)
+
+  def _insert_at(self, job_id, position):
+    # Moving a job next to others makes it adopt their priority and deadline
+    # so that the manual order holds.
+    position = min(max(position, 0), len(self._entries))
+    before = self._entries[position - 1][0] if position > 0 else None
+    after = self._entries[position][0] if position < len(self._entries) else None
+    if after == None and before == None:
+      key = self._key(0, None, 0.0)
+    elif after == None:
+      key = before[:2] + (before[2] + 1,)
+    elif before == None or before[:2] != after[:2]:
+      key = after[:2] + (after[2] - 1,)
+    else:
+      rank = (before[2] + after[2]) / 2
+      if not before[2] < rank < after[2]:
+        # Out of float precision between the two ranks
+        self._renumber()
+        return self._insert_at(job_id, position)
+      key = after[:2] + (rank,)
+    self._insert(job_id, key)
+
+  def _renumber(self):
+    self._entries = [
+      (key[:2] + (float(i),), job_id)
+      for i, (key, job_id) in enumerate(self._entries)
+    ]
+    self._keys = dict((job_id, key) for key, job_id in self._entries)
+    self._next_rank = float(len(self._entries))
+    self.renumbers += 1
@@ -0,0 +1,76 @@
+import threading, Queue
+
+class JobReader(object):
+  # Streams a job's lines from storage to a printer driver in batches,
+  # starting from any line so an interrupted print can be resumed. A thread
+  # reads up to `prefetch` batches ahead so the driver doesn't wait on the
+  # disk, memory use is bounded by the buffered batches whatever the size of
+  # the job.
+  def __init__(self, body, start_line= 0, batch_size= 64, prefetch= 8):
+    self.body = body
+    self.batch_size = batch_size
+    # The next line to be read
+    self.line = min(max(start_line, 0), len(body))
+    self._queue = Queue.Queue(prefetch)
+    self._closed = False
+    self._thread = threading.Thread(target= self._prefetch, name= "construct-reader")
+    self._thread.daemon = True
+    self._thread.start()
+
+  def __iter__(self):
+    for batch in iter(self.next_batch, []):
+      for line in batch: yield line
+
+  def batches(self):
+    return iter(self.next_batch, [])
+
+  def next_batch(self):
+    # The next batch of lines or [] once the job has been read
+    if self._closed: return []
+    item = self._queue.get()
+    if item == None or self._closed:
+      self._closed = True
+      return []
+    start, batch = item
+    self.line = start + len(batch)
+    return batch
+
+  def byte_offset(self):
+    return self.body.byte_offset(self.line)
+
+  def progress(self):
+    return self.body.progress(self.line)
+
+  def __len__(self):
+    return len(self.body)
+
+  def close(self):
+    self._closed = True
+    # Unblocking the prefetch thread if the buffer is full
+    try:
+      while True: self._queue.get_nowait()
+    except Queue.Empty:
+      pass
+    # and a driver thread waiting for the next batch
+    try:
+      self._queue.put_nowait(None)
+    except Queue.Full:
+      pass
+
+  def _put(self, item):
+    while not self._closed:
+      try:
+        self._queue.put(item, timeout= 0.1)
+        return
+      except Queue.Full:
+        pass
+
+  def _prefetch(self):
+    body = self.body
+    n = self.line
+    total = len(body)
+    while n < total and not self._closed:
+      end = min(n + self.batch_size, total)
+      self._put((n, [body.line(i) for i in xrange(n, end)]))
+      n = end
+    self._put(None)
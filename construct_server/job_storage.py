@@ -0,0 +1,150 @@
+import os, mmap, tempfile
+from array import array
+from bisect import bisect_right
+
+def index_typecode(size):
+  return 'I' if size <= 0xFFFFFFFF else 'L'
+
+def build_line_index(data, size):
+  # Start offsets of every line followed by the body's size so that line n
+  # spans offsets[n]:offsets[n+1]. 32 bit offsets are used whenever they fit.
+  offsets = array(index_typecode(size), [0])
+  find = data.find
+  i = find("\n")
+  while i != -1:
+    offsets.append(i + 1)
+    i = find("\n", i + 1)
+  if offsets[-1] != size: offsets.append(size)
+  return offsets
+
+class JobBody(object):
+  # A print job's G-code kept on disk and read through mmap. The line index
+  # is built once when the job is queued (or passed in, already built) so
+  # that line counts, random access to a line and line to byte mapping never
+  # rescan the file. Bodies restored from the journal are only mapped and
+  # indexed on first use, from their sidecar index if they have one.
+  def __init__(self, path, offsets= None):
+    self.path = path
+    self.size = os.path.getsize(path)
+    if offsets != None: self.offsets = offsets
+
+  def __getattr__(self, name):
+    # Only called for attributes that haven't been loaded yet
+    if name in ("_file", "_map"): self._open()
+    elif name == "offsets": self.offsets = self._load_index()
+    else: raise AttributeError(name)
+    return self.__dict__[name]
+
+  def _open(self):
+    self._file = open(self.path, "rb")
+    if self.size > 0:
+      self._map = mmap.mmap(self._file.fileno(), 0, access= mmap.ACCESS_READ)
+    else:
+      self._map = ""
+
+  @property
+  def index_path(self):
+    return self.path + ".idx"
+
+  def _load_index(self):
+    typecode = index_typecode(self.size)
+    try:
+      with open(self.index_path, "rb") as f:
+        offsets = array(typecode)
+        offsets.fromstring(f.read())
+      # An index left by an older body at the same path is rebuilt
+      if len(offsets) > 0 and offsets[0] == 0 and offsets[-1] == self.size:
+        return offsets
+    except (IOError, ValueError):
+      pass
+    return build_line_index(self._map, self.size)
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def __iter__(self):
+    return self.lines()
+
+  def line(self, n):
+    return self._map[self.offsets[n]:self.offsets[n + 1]].rstrip("\r\n")
+
+  def lines(self, start= 0):
+    for n in xrange(start, len(self)): yield self.line(n)
+
+  def byte_offset(self, line):
+    # The offset of the start of a line, len(self) maps to the end of the body
+    return self.offsets[min(max(line, 0), len(self))]
+
+  def line_at(self, byte_offset):
+    return max(bisect_right(self.offsets, byte_offset) - 1, 0)
+
+  def progress(self, line):
+    if self.size == 0: return 1.0
+    return float(self.byte_offset(line)) / self.size
+
+  def close(self):
+    if not "_file" in self.__dict__: return
+    if self.size > 0: self._map.close()
+    self._file.close()
+
+class JobStorage(object):
+  # Owns the directory print job bodies are stored in. With `sidecars` each
+  # body's line index is saved next to it so it needn't be rebuilt when the
+  # body is loaded again after a restart.
+  def __init__(self, directory= None, sidecars= False):
+    self.directory = directory or tempfile.gettempdir()
+    self.sidecars = sidecars
+
+  def spool(self, file_name):
+    # An open file to write a job body to as it is received
+    return tempfile.NamedTemporaryFile(
+      prefix= "job_",
+      suffix= os.path.splitext(file_name)[1],
+      dir= self.directory,
+      delete= False
+    )
+
+  def store(self, file_name, body):
+    # Accepts a JobBody, a file on disk or a str and returns a JobBody
+    if isinstance(body, JobBody): return body
+    body = JobBody(self.write(file_name, body))
+    self.save_index(body)
+    return body
+
+  def contains(self, path):
+    if not isinstance(path, basestring) or not os.path.isfile(path): return False
+    directory = os.path.realpath(self.directory)
+    return os.path.dirname(os.path.realpath(path)) == directory
+
+  def load(self, path):
+    # A stored body, mapped and indexed lazily
+    return JobBody(path)
+
+  def save_index(self, body):
+    if not self.sidecars: return
+    tmp = body.index_path + ".tmp"
+    with open(tmp, "wb") as f: body.offsets.tofile(f)
+    os.rename(tmp, body.index_path)
+
+  def write(self, file_name, body):
+    # Returns the path of a file on disk holding the body, writing it to one
+    # if need be
+    if isinstance(body, JobBody): return body.path
+    # Files already in storage (spooled uploads) are adopted, others are
+    # copied in since discarding the job deletes its body
+    if hasattr(body, "read") and self.contains(getattr(body, "name", "")):
+      body.close()
+      return body.name
+    f = self.spool(file_name)
+    if hasattr(body, "read"):
+      if hasattr(body, "seek"): body.seek(0)
+      for chunk in iter(lambda: body.read(1024 * 1024), ""): f.write(chunk)
+    else:
+      f.write(body)
+    f.close()
+    return f.name
+
+  def discard(self, body):
+    body.close()
+    for path in [body.path, body.index_path]:
+      if os.path.exists(path): os.remove(path)
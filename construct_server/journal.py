@@ -0,0 +1,70 @@
+import os, json
+from construct_logging import get_logger
+
+log = get_logger("journal")
+
+class Journal(object):
+  # An append-only log of JSON records, one per line, kept in `directory`
+  # alongside a snapshot. Records are replayed on top of the snapshot on
+  # startup so they must be idempotent (the latest state of something rather
+  # than a change to it). Once `compact_size` records have been appended the
+  # journal is compacted: `snapshot()` (a list of records holding the whole
+  # state) is written to a new snapshot which replaces the old one and the
+  # log is truncated.
+  def __init__(self, directory, snapshot, compact_size= 1000, fsync= False):
+    self.log_path = os.path.join(directory, "journal.jsonl")
+    self.snapshot_path = os.path.join(directory, "snapshot.json")
+    self.snapshot = snapshot
+    self.compact_size = compact_size
+    self.fsync = fsync
+    # True if the log ended in a record cut short, by a crash for instance
+    self.damaged = False
+    self._count = 0
+    self._file = None
+    if not os.path.isdir(directory): os.makedirs(directory)
+
+  def load(self):
+    # The snapshot's records followed by the log's
+    records = []
+    if os.path.exists(self.snapshot_path):
+      with open(self.snapshot_path, "rb") as f: records = json.load(f)
+    if os.path.exists(self.log_path):
+      with open(self.log_path, "rb") as f:
+        for line in f:
+          try:
+            records.append(json.loads(line))
+          except ValueError:
+            log.warning("Ignoring the end of a damaged journal")
+            self.damaged = True
+            break
+          self._count += 1
+    return records
+
+  def append(self, record):
+    if self._file == None: self._file = open(self.log_path, "ab")
+    self._file.write(json.dumps(record) + "\n")
+    self._flush(self._file)
+    self._count += 1
+    if self._count >= self.compact_size: self.compact()
+
+  def compact(self):
+    # The new snapshot is complete on disk before it replaces the old one. A
+    # crash before the log is truncated replays the log over a snapshot that
+    # already includes it, which is harmless since records are idempotent.
+    tmp = self.snapshot_path + ".tmp"
+    with open(tmp, "wb") as f:
+      json.dump(self.snapshot(), f)
+      self._flush(f)
+    os.rename(tmp, self.snapshot_path)
+    if self._file != None: self._file.close()
+    self._file = open(self.log_path, "wb")
+    self._count = 0
+    self.damaged = False
+
+  def _flush(self, f):
+    f.flush()
+    if self.fsync: os.fsync(f.fileno())
+
+  def close(self):
+    if self._file != None: self._file.close()
+    self._file = None
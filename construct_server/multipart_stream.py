@@ -0,0 +1,123 @@
+import cgi
+from cStringIO import StringIO
+
+class MultipartStreamParser(object):
+  # An incremental multipart/form-data parser. Chunks are fed in as they are
+  # read off the socket and file parts are written straight to the file
+  # object returned by open_file(name, filename) so memory use is bounded by
+  # the chunk size rather than the size of the upload. open_file may return
+  # None to discard a part.
+  max_header_size = 16 * 1024
+  max_field_size = 64 * 1024
+
+  def __init__(self, boundary, open_file):
+    self.files = {}
+    self.arguments = {}
+    self._open_file = open_file
+    self._first_delimiter = "--" + boundary
+    self._delimiter = "\r\n--" + boundary
+    self._buffer = ""
+    self._state = "preamble"
+    self._part = None
+
+  def feed(self, data):
+    self._buffer += data
+    while self._state != "done":
+      if self._state == "preamble":
+        if not self._skip_preamble(): return
+      elif self._state == "delimiter":
+        # A delimiter is followed by either CRLF and the next part or "--"
+        if len(self._buffer) < 2: return
+        if self._buffer[:2] == "--":
+          self._state = "done"
+          self._buffer = ""
+        elif self._buffer[:2] == "\r\n":
+          self._buffer = self._buffer[2:]
+          self._state = "headers"
+        else:
+          raise ValueError("Malformed multipart delimiter")
+      elif self._state == "headers":
+        if not self._read_headers(): return
+      elif self._state == "body":
+        if not self._read_body(): return
+
+  def close(self):
+    if self._state != "done":
+      self._abort()
+      raise ValueError("Incomplete multipart body")
+
+  def _skip_preamble(self):
+    i = self._buffer.find(self._first_delimiter)
+    if i == -1:
+      self._buffer = self._buffer[-len(self._first_delimiter):]
+      return False
+    self._buffer = self._buffer[i + len(self._first_delimiter):]
+    self._state = "delimiter"
+    return True
+
+  def _read_headers(self):
+    i = self._buffer.find("\r\n\r\n")
+    if i == -1:
+      if len(self._buffer) > self.max_header_size:
+        raise ValueError("Multipart headers too large")
+      return False
+    headers = {}
+    for line in self._buffer[:i].split("\r\n"):
+      k, sep, v = line.partition(":")
+      if sep: headers[k.strip().lower()] = v.strip()
+    self._buffer = self._buffer[i + 4:]
+    disposition, params = cgi.parse_header(headers.get("content-disposition", ""))
+    if disposition != "form-data" or not 'name' in params:
+      raise ValueError("Invalid multipart Content-Disposition")
+    part = dict(name= params['name'], size= 0)
+    if 'filename' in params:
+      part['filename'] = params['filename']
+      part['content_type'] = headers.get("content-type", "application/unknown")
+      part['file'] = self._open_file(params['name'], params['filename'])
+    else:
+      part['file'] = StringIO()
+    self._part = part
+    self._state = "body"
+    return True
+
+  def _read_body(self):
+    i = self._buffer.find(self._delimiter)
+    if i == -1:
+      # Holding back enough bytes to match a delimiter split across chunks
+      keep = len(self._delimiter) - 1
+      if len(self._buffer) > keep:
+        self._write(self._buffer[:-keep])
+        self._buffer = self._buffer[-keep:]
+      return False
+    self._write(self._buffer[:i])
+    self._buffer = self._buffer[i + len(self._delimiter):]
+    self._finish_part()
+    self._state = "delimiter"
+    return True
+
+  def _write(self, data):
+    part = self._part
+    part['size'] += len(data)
+    if not 'filename' in part and part['size'] > self.max_field_size:
+      raise ValueError("Multipart field %s too large"%part['name'])
+    if part['file'] != None: part['file'].write(data)
+
+  def _finish_part(self):
+    part = self._part
+    self._part = None
+    if not 'filename' in part:
+      value = part['file'].getvalue()
+      self.arguments.setdefault(part['name'], []).append(value)
+    elif part['file'] != None:
+      part['file'].flush()
+      part['file'].seek(0)
+      self.files.setdefault(part['name'], []).append(dict(
+        filename= part['filename'],
+        content_type= part['content_type'],
+        file= part['file']
+      ))
+
+  def _abort(self):
+    if self._part != None and self._part['file'] != None:
+      self._part['file'].close()
+    self._part = None
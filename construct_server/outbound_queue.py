@@ -0,0 +1,62 @@
+from collections import deque
+from broadcast_frame import BroadcastFrame
+from event_coalescer import EventCoalescer
+
+class OutboundQueue(object):
+  # Frames waiting for a slow session's socket to drain. Once it holds more
+  # than max_bytes or max_frames its queued events are coalesced so that only
+  # the latest change to each target path is kept.
+  def __init__(self, max_bytes, max_frames):
+    self.max_bytes = max_bytes
+    self.max_frames = max_frames
+    self.frames = deque()
+    self.bytes = 0
+
+  def __len__(self):
+    return len(self.frames)
+
+  def push(self, frame):
+    self.frames.append(frame)
+    self.bytes += len(frame.payload)
+
+  def popleft(self):
+    frame = self.frames.popleft()
+    self.bytes -= len(frame.payload)
+    return frame
+
+  def clear(self):
+    self.frames.clear()
+    self.bytes = 0
+
+  def over_limit(self):
+    return self.bytes > self.max_bytes or len(self.frames) > self.max_frames
+
+  def coalesce(self):
+    # Merging each run of frames with known events into a single frame.
+    # Frames without events (pre-serialized snapshots) are kept as they are.
+    frames = list(self.frames)
+    self.clear()
+    run = EventCoalescer()
+    for frame in frames:
+      if frame.events == None:
+        if len(run) > 0: self.push(BroadcastFrame(run.events()))
+        run.clear()
+        self.push(frame)
+      else:
+        for event in frame.events: run.push(event)
+    if len(run) > 0: self.push(BroadcastFrame(run.events()))
+
+  def resync(self, snapshot):
+    # Replaces the queued component tree events with a snapshot of the tree.
+    # Events the snapshot doesn't cover (acks, errors and session events)
+    # are kept and follow it. Older snapshots are superseded.
+    events = []
+    for frame in self.frames:
+      if frame.events == None: continue
+      events += [event for event in frame.events if not is_tree_event(event)]
+    self.clear()
+    self.push(snapshot)
+    if len(events) > 0: self.push(BroadcastFrame(events))
+
+def is_tree_event(event):
+  return 'target' in event and list(event['target'][:1]) != ['session']
@@ -1,95 +1,400 @@
-import traceback, time, tornado, os
+import traceback, time, tornado, tornado.gen, os, logging
 from event_emitter import EventEmitter
+from job_order import JobOrder
+from adaptive_timer import AdaptiveTimer
+from job_reader import JobReader
+from construct_logging import get_logger
+
+log = get_logger("jobs")
 
 class PrintJobQueue(EventEmitter):
 
   def __init__(self, server):
     super(PrintJobQueue, self).__init__()
-    self.list = []
+    # Jobs by id. This is also the server's components['jobs'].
+    self.by_id = {}
+    # The print order of the queued jobs' ids
+    self.order = JobOrder()
     self.current_job = None
     self.server = server
     self.printer = server.printer
     self.__next_id = 0
+    settings = server.settings
+    # Seconds between polls of the printer: while printing, while idle and
+    # close to the end of a job
+    self.poll_interval = settings.get("job_poll_interval", 1.0)
+    self.idle_poll_interval = settings.get("job_idle_poll_interval", 5.0)
+    self.final_poll_interval = settings.get("job_final_poll_interval", 0.1)
+    self.poller = AdaptiveTimer(self.iterate_print_job_loop, server.ioloop)
+    # Lines per batch and batches read ahead for printers that stream jobs
+    self.stream_batch_size = settings.get("stream_batch_size", 64)
+    self.stream_prefetch = settings.get("stream_prefetch", 8)
+    self.reader = None
+    # Printers that are event emitters can push print_finished and
+    # line_progress events, polling is then only a fallback.
+    self.push_events = hasattr(self.printer, "listeners")
+    if self.push_events: self.printer.listeners.add(self)
+    # Jobs changed since the journal was last written to
+    self._journal_pending = set()
+    self._journal_scheduled = False
+
+  def start(self):
+    self.poller.start()
+
+  def queued(self):
+    return [self.by_id[job_id] for job_id in self.order]
 
   def public_list(self):
-    # A sanitized version of list for public consumption via construct
-    list = self.list
-    if not self.current_job == None: list = [self.current_job] + list
-    return  [self.sanitize(job) for job in list]
+    # A sanitized version of the queue for public consumption via construct:
+    # the current job, the queued jobs in order and then every other job in
+    # the tree (processing, failed or finished ones)
+    jobs = self.queued()
+    if not self.current_job == None: jobs = [self.current_job] + jobs
+    listed = set(job['id'] for job in jobs)
+    jobs += [self.by_id[job_id] for job_id in sorted(self.by_id)
+      if not job_id in listed]
+    return [self.sanitize(job) for job in jobs]
 
   def sanitize(self, job):
-    whitelist = ['id', 'file_name', 'status', 'total_lines', 'current_line']
-    return {k:v for k,v in job.iteritems() if k in whitelist}
+    whitelist = [
+      'id', 'file_name', 'status', 'total_lines', 'current_line', 'progress',
+      'priority', 'deadline', 'processing_stage', 'processing_progress',
+      'analysis'
+    ]
+    data = {k:v for k,v in job.iteritems() if k in whitelist}
+    if job['id'] in self.order: data['position'] = self.order.position(job['id'])
+    return data
 
   def display_summary(self):
-    print "Print Jobs:"
-    for job in self.list: print "  %i: %s"%(job['id'], job['file_name'])
-    print ""
+    if not log.isEnabledFor(logging.DEBUG): return
+    jobs = ["  %i: %s"%(job['id'], job['file_name']) for job in self.queued()]
+    log.debug("Print Jobs:\n%s", "\n".join(jobs))
 
   def do_get_jobs(self):
     return dict(jobs= self.public_list())
 
-  def do_add_job(self, file_name, body):
-    ext = os.path.splitext(file_name)[1]
+  def do_add_job(self, file_name, body, priority= 0, deadline= None):
+    # Job bodies are kept on disk, memory mapped and indexed by line
+    body = self.server.job_storage.store(file_name, body)
+    job = self._new_job(file_name, body, priority, deadline, 'queued')
+    self.order.add(job['id'], priority, deadline)
+    job['position'] = self.order.position(job['id'])
+    with self.server.batch():
+      self.server.c_add(['jobs', job['id']], job, internal= True)
+      self.update_positions()
+    self.journal_job(job['id'])
+    log.info("Added %s", file_name)
+    return job
+
+  def _new_job(self, file_name, body, priority, deadline, status, job_id= None):
+    if job_id == None: job_id = self.__next_id
     job = dict(
-      id = self.__next_id,
+      id = job_id,
       file_name = file_name,
       body = body,
-      position = self.list.__len__(),
-      #position = lambda: self.list.index(job),
-      total_lines = self.printer.total_print_lines(body),
+      position = None,
+      priority = priority,
+      deadline = deadline,
+      total_lines = len(body) if body != None else 0,
       current_line = 0,
-      status = 'queued',
+      progress = 0.0,
+      processing_stage = None,
+      processing_progress = None,
+      analysis = None,
+      status = status,
       type = "job"
     )
-    self.__next_id += 1
-    self.list.append(job)
+    self.__next_id = max(self.__next_id, job_id + 1)
+    return job
+
+  def ingest_job(self, file_name, body, priority= 0, deadline= None,
+      post_process= None):
+    # Adds a job straight away as "processing" and queues it once the
+    # job ingest has post processed, stored and indexed its body
+    job = self._new_job(file_name, None, priority, deadline, 'processing')
     self.server.c_add(['jobs', job['id']], job, internal= True)
-    print "Added %s"%(file_name)
+    log.info("Processing %s", file_name)
+    def on_progress(stage, progress):
+      if not job['id'] in self.by_id: return
+      with self.server.batch():
+        self.server.c_set(['jobs', job['id'], 'processing_stage'], stage)
+        self.server.c_set(['jobs', job['id'], 'processing_progress'], progress)
+    future = self.server.job_ingest.ingest(file_name, body,
+      post_process= post_process, on_progress= on_progress
+    )
+    self.server.ioloop.add_future(future,
+      lambda future: self._ingested(job, future)
+    )
+    return job
+
+  def _ingested(self, job, future):
+    path = ['jobs', job['id']]
+    try:
+      body, analysis = future.result()
+    except Exception:
+      log.exception("Processing %s failed", job['file_name'])
+      if job['id'] in self.by_id: self.server.c_set(path + ['status'], 'failed')
+      return
+    # The job may have been removed while it was processing
+    if not job['id'] in self.by_id: return self.server.job_storage.discard(body)
+    job['body'] = body
+    self.order.add(job['id'], job['priority'], job['deadline'])
+    with self.server.batch():
+      self.update_positions()
+      self.server.c_set(path + ['total_lines'], len(body))
+      self.server.c_set(path + ['analysis'], analysis)
+      self.server.c_set(path + ['processing_stage'], None)
+      self.server.c_set(path + ['processing_progress'], None)
+      self.server.c_set(path + ['status'], 'queued')
+    log.info("Added %s", job['file_name'])
 
   def do_rm_job(self, job_id):
     job = self.server.c_get(['jobs', int(job_id)])
     if job['status'] in ["printing", "finished"]:
       raise Exception("Cannot remove a %s job"%job['status'])
-    self.list.remove(job)
-    self.server.c_rm(['jobs', job['id']])
-    print "Print Job Removed"
+    if job['id'] in self.order: self.order.remove(job['id'])
+    with self.server.batch():
+      self.server.c_rm(['jobs', job['id']])
+      self.update_positions()
+    self.journal_job(job['id'])
+    if job['body'] != None: self.server.job_storage.discard(job['body'])
+    log.info("Print Job Removed")
+
+  # Component tree events for a job are fired with the job's path and value
+  def on_job_position_change(self, job_path, position, data):
+    job = self.by_id[job_path[-1]]
+    if not job['id'] in self.order or position == None: return
+    renumbers = self.order.renumbers
+    self.order.move(job['id'], int(position))
+    self.journal_job(job['id'])
+    # Renumbering the order changed the rank of every queued job
+    if self.order.renumbers != renumbers:
+      for job_id in self.order: self.journal_job(job_id)
+    # The job adopts the priority and deadline of the jobs it was moved to
+    priority, deadline = self.order.schedule(job['id'])
+    with self.server.batch():
+      self.server.c_set(job_path + ['priority'], priority)
+      self.server.c_set(job_path + ['deadline'], deadline)
+      # Replacing the requested position with the job's actual one
+      self.update_positions()
+    log.info("Print #%s Job Updated ( %s ) to position %s.",
+      job['id'], job['file_name'], position)
+
+  def on_job_priority_change(self, job_path, priority, data):
+    self._reschedule(self.by_id[job_path[-1]])
+
+  def on_job_deadline_change(self, job_path, deadline, data):
+    self._reschedule(self.by_id[job_path[-1]])
+
+  def on_job_status_change(self, job_path, status, data):
+    self.journal_job(job_path[-1])
+
+  def _reschedule(self, job):
+    if not job['id'] in self.order: return
+    self.order.reschedule(job['id'], job['priority'] or 0, job['deadline'])
+    self.journal_job(job['id'])
+    self.update_positions()
+
+  def update_positions(self):
+    # Keeps the position of each job in the component tree in step with the
+    # order, queued jobs shift whenever a job is added, removed or moved
+    positions = dict((job_id, i) for i, job_id in enumerate(self.order))
+    with self.server.batch():
+      for job_id, job in self.by_id.iteritems():
+        position = positions.get(job_id)
+        if job['position'] == position: continue
+        self.server.c_set(['jobs', job_id, 'position'], position, internal= True)
+
+  # Journaling. Jobs are journaled once their body is stored, as the latest
+  # state of the job rather than its changes, so that records can be replayed
+  # over a snapshot. Changed jobs are written once per IOLoop tick.
+  journaled_fields = [
+    'id', 'file_name', 'status', 'total_lines', 'priority', 'deadline',
+    'analysis'
+  ]
 
-  def on_job_position_change(self, parent_path, job, position):
-    self.list.remove(job)
-    self.list.insert(position, job)
-    print position
-    print "Print #%s Job Updated ( %s )."%(job['id'], job['file_name'])
+  def journal_job(self, job_id):
+    if self.server.journal == None: return
+    self._journal_pending.add(job_id)
+    if self._journal_scheduled: return
+    self._journal_scheduled = True
+    self.server.ioloop.add_callback(self.flush_journal)
+
+  def flush_journal(self):
+    self._journal_scheduled = False
+    pending, self._journal_pending = self._journal_pending, set()
+    for job_id in sorted(pending):
+      if job_id in self.by_id: record = self.journal_record(self.by_id[job_id])
+      else: record = dict(op= "rm_job", id= job_id)
+      if record != None: self.server.journal.append(record)
+
+  def journal_record(self, job):
+    if job['body'] == None: return None
+    record = {k: job[k] for k in self.journaled_fields}
+    rank = self.order.rank(job['id']) if job['id'] in self.order else None
+    record.update(op= "job", path= job['body'].path, rank= rank)
+    return record
+
+  def journal_records(self):
+    # The whole queue, for journal snapshots
+    records = [dict(op= "next_job_id", id= self.__next_id)]
+    for job_id in sorted(self.by_id):
+      record = self.journal_record(self.by_id[job_id])
+      if record != None: records.append(record)
+    return records
+
+  def restore(self, records):
+    # Rebuilds the queue from the journal on startup. Job bodies are already
+    # on disk and only mapped and indexed once they're printed so restoring
+    # doesn't read them.
+    jobs = {}
+    for record in records:
+      op = record['op']
+      if op == "job": jobs[record['id']] = record
+      elif op == "rm_job": jobs.pop(record['id'], None)
+      elif op == "next_job_id": self.__next_id = max(self.__next_id, record['id'])
+    for job_id, record in sorted(jobs.iteritems()):
+      if not os.path.exists(record['path']):
+        log.warning("Dropping job #%s, its body is missing", job_id)
+        self.__next_id = max(self.__next_id, job_id + 1)
+        self.journal_job(job_id)
+        continue
+      status = record['status']
+      # Jobs interrupted by the restart are queued again ahead of their equals
+      if status == "printing":
+        status = 'queued'
+        record['rank'] = 0.0
+        self.journal_job(job_id)
+      job = self._new_job(record['file_name'], None, record['priority'],
+        record['deadline'], status, job_id
+      )
+      job['body'] = self.server.job_storage.load(record['path'])
+      job['total_lines'] = record['total_lines']
+      job['analysis'] = record['analysis']
+      if status == "finished":
+        job.update(current_line= job['total_lines'], progress= 1.0)
+      self.by_id[job_id] = job
+      if status == "queued":
+        self.order.add(job_id, job['priority'] or 0, job['deadline'], record['rank'])
+    for job_id in self.order:
+      self.by_id[job_id]['position'] = self.order.position(job_id)
+    log.info("Restored %i print jobs", len(self.by_id))
 
   # proposed future print quantity functionality:
   # def on_job_qty_change(self, job, qty):
 
+  # Printer events. These may be fired from the printer's own threads.
+  def on_print_finished(self):
+    self.server.ioloop.add_callback(self.poller.poke)
+
+  def on_line_progress(self, line):
+    self.server.ioloop.add_callback(self.update_job_progress, line)
+
+  def on_status_change(self, parent_path, status, data):
+    # Starting the first job right away when printing is started
+    if status == "printing": self.poller.poke()
+
+  @tornado.gen.coroutine
   def iterate_print_job_loop(self):
-    # This is a polling work around to the current lack of events in printcore
-    # A better solution would be one in which a print_finised event could be 
-    # listend for asynchronously without polling.
-    if self.server.c_get(['status'])=="printing" and self.printer.is_printing():
-      if self.current_job != None:
-        self.update_job_progress(line=self.current_job.total_lines)
-        self.server.c_set([self.current_job.id, "status"], "finished")
-        print "Print job complete."
-
-      pause_between_prints = self.server.c_get(['pause_between_prints'])
-      no_job = self.current_job != None
-      if (pause_between_prints and no_job) or len(self.list) == 0:
+    # Polls the printer for job completion and progress and resolves to the
+    # seconds until the next poll.
+    printer = self.server.async_printer
+    if self.server.c_get(['status']) != "printing":
+      raise tornado.gen.Return(self.idle_poll_interval)
+    printing = yield printer.call("is_printing")
+    if not printing: yield self.next_job()
+    if self.current_job == None:
+      raise tornado.gen.Return(self.idle_poll_interval)
+    # Progress is pushed by printers that emit line_progress
+    if not self.push_events:
+      line = yield printer.call("current_print_line")
+      self.update_job_progress(line)
+    raise tornado.gen.Return(self.next_poll_interval())
+
+  def next_poll_interval(self):
+    # Polling faster in the final stretch of a job so the next job starts
+    # promptly, unless the printer reports when it's finished.
+    if self.push_events: return self.idle_poll_interval
+    job = self.current_job
+    remaining = 1.0 - job['progress']
+    interval = min(self.poll_interval, remaining * 20 * self.poll_interval)
+    return max(interval, self.final_poll_interval)
+
+  @tornado.gen.coroutine
+  def next_job(self):
+    # The printer is done with the current job (if any)
+    self.close_reader()
+    if self.current_job != None:
+      self.update_job_progress(line=self.current_job['total_lines'])
+      self.server.c_set(
+        ['jobs', self.current_job['id'], "status"], "finished"
+      )
+      log.info("Print job complete.")
+
+    pause_between_prints = self.server.c_get(['pause_between_prints'])
+    finished_job = self.current_job != None
+    if (pause_between_prints and finished_job) or len(self.order) == 0:
+      self.current_job = None
+      self.server.c_set(['status'], "idle")
+    elif len(self.order) > 0:
+      log.info("Starting the next print job")
+      job = self.by_id[self.order.pop()]
+      self.update_positions()
+      try:
+        yield self.start_job(job)
+      except Exception:
+        log.exception("Could not start print job #%s", job['id'])
+        self.order.add(job['id'], job['priority'], job['deadline'])
+        self.journal_job(job['id'])
+        self.update_positions()
         self.current_job = None
-        self.server.c_set(['status'], "idle")
-      elif len(self.list) > 0:
-        print "Starting the next print job"
-        self.current_job = self.list.pop(0)
-        self.printer.start_print_job(self.current_job)
-        self.server.c_set(['jobs', self.current_job.id, 'status'], "printing")
-      self.display_summary()
-
-    # Updating the job progress
-    self.update_job_progress()
-
-  def update_job_progress(self, line=None):
-    if self.current_job == None: return
-    if line == None: line = self.printer.current_print_line
-    self.server.c_set(['jobs', self.current_job.id, 'current_line'], line)
+        # An estop cancelling the job has already set the status
+        if self.server.c_get(['status']) == "printing":
+          self.server.c_set(['status'], "idle")
+        return
+      self.current_job = job
+      self.server.c_set(
+        ['jobs', self.current_job['id'], 'status'], "printing"
+      )
+    self.display_summary()
+
+  def start_job(self, job, line= 0):
+    # Printers that define start_print_stream pull the job's lines from a
+    # JobReader rather than being handed the whole job body
+    if not hasattr(self.printer, "start_print_stream"):
+      return self.server.async_printer.call("start_print_job", job)
+    self.reader = JobReader(job['body'], line,
+      batch_size= self.stream_batch_size, prefetch= self.stream_prefetch
+    )
+    return self.server.async_printer.call("start_print_stream", job, self.reader)
+
+  def close_reader(self):
+    if self.reader != None: self.reader.close()
+    self.reader = None
+
+  @tornado.gen.coroutine
+  def do_resume_job(self, line= None):
+    # Restarts an interrupted (e.g. estopped) print of the current job from
+    # the line it had reached or the given line
+    job = self.current_job
+    if job == None: raise Exception("There is no print job to resume")
+    if not hasattr(self.printer, "start_print_stream"):
+      raise Exception("The printer can not resume print jobs")
+    if self.server.c_get(['status']) == "printing":
+      raise Exception("%s is already printing"%job['file_name'])
+    if line == None: line = job['current_line']
+    if type(line) != int or not 0 <= line <= job['total_lines']:
+      raise Exception("line must be a line number of the job")
+    self.close_reader()
+    yield self.start_job(job, line)
+    with self.server.batch():
+      self.update_job_progress(line)
+      self.server.c_set(['status'], "printing")
+    log.info("Resumed print job #%s at line %i", job['id'], line)
+
+  def update_job_progress(self, line):
+    job = self.current_job
+    if job == None: return
+    with self.server.batch():
+      self.server.c_set(['jobs', job['id'], 'current_line'], line)
+      self.server.c_set(['jobs', job['id'], 'progress'], job['body'].progress(line))
@@ -0,0 +1,28 @@
+import time
+
+class ProgressThrottle(object):
+  # Decides when a progress update is worth sending: at least `interval`
+  # seconds must have passed and the progress must have advanced by `step`
+  # percent since the last update. Setting either to 0 disables that limit.
+  # Completion is always reported.
+  def __init__(self, total, interval= 0.5, step= 1.0, clock= time.time):
+    self.total = total
+    self.interval = interval
+    self.step = step
+    self.clock = clock
+    self._last_time = None
+    self._last_percent = None
+
+  def percent(self, value):
+    if not self.total: return 100.0
+    return 100.0 * value / self.total
+
+  def ready(self, value):
+    now = self.clock()
+    percent = self.percent(value)
+    if self._last_time != None and percent < 100.0:
+      if now - self._last_time < self.interval: return False
+      if percent - self._last_percent < self.step: return False
+    self._last_time = now
+    self._last_percent = percent
+    return True
@@ -0,0 +1,63 @@
+import collections
+from functools import partial
+from tornado.concurrent import TracebackFuture
+
+class RawPipeline(object):
+  # Sends blocks of raw G-code to the printer one line per do_raw call,
+  # keeping up to `window` lines in flight (queued for the printer's thread)
+  # so throughput is limited by the printer rather than by a round trip per
+  # line. Blocks are sent in the order they arrive, a failed line (e.g. one
+  # cancelled by an estop) fails its block and drops the block's remaining
+  # lines. Lines are only sent while can_send() is true, the waiting blocks
+  # are failed otherwise.
+  def __init__(self, async_printer, ioloop, window= 16, can_send= None):
+    self.printer = async_printer
+    self.ioloop = ioloop
+    self.window = window
+    self.can_send = can_send or (lambda: True)
+    self.in_flight = 0
+    self._pending = collections.deque()
+
+  def send(self, lines, on_progress= None):
+    # Resolves to dict(lines= n) once every line has been sent.
+    # on_progress(sent, total) is called as lines are sent.
+    block = dict(
+      total= len(lines),
+      sent= 0,
+      future= TracebackFuture(),
+      on_progress= on_progress
+    )
+    if block['total'] == 0: block['future'].set_result(dict(lines= 0))
+    for line in lines: self._pending.append((block, line))
+    self._fill()
+    return block['future']
+
+  def cancel(self, reason):
+    # Fails every block with lines still waiting to be sent
+    while len(self._pending) > 0:
+      block, line = self._pending.popleft()
+      if not block['future'].done(): block['future'].set_exception(Exception(reason))
+
+  def _fill(self):
+    if len(self._pending) > 0 and not self.can_send():
+      return self.cancel("Raw commands can not be sent now")
+    while self.in_flight < self.window and len(self._pending) > 0:
+      block, line = self._pending.popleft()
+      if block['future'].done(): continue
+      self.in_flight += 1
+      future = self.printer.call("do_raw", *line.split())
+      self.ioloop.add_future(future, partial(self._sent, block))
+
+  def _sent(self, block, future):
+    self.in_flight -= 1
+    if block['future'].done():
+      pass
+    elif future.exception() != None:
+      block['future'].set_exception(future.exception())
+    else:
+      block['sent'] += 1
+      if block['on_progress'] != None:
+        block['on_progress'](block['sent'], block['total'])
+      if block['sent'] == block['total']:
+        block['future'].set_result(dict(lines= block['total']))
+    self._fill()
@@ -0,0 +1,85 @@
+from array import array
+
+class SensorHistory(object):
+  # A fixed size ring buffer of (timestamp, current, target) samples kept in
+  # arrays of doubles so its memory doesn't grow with uptime. Samples are
+  # recorded when a reading or target changes so a sensor's value holds
+  # until its next sample.
+  def __init__(self, capacity):
+    self.capacity = capacity
+    self.times = array('d', [0.0]) * capacity
+    self.currents = array('d', [0.0]) * capacity
+    self.targets = array('d', [0.0]) * capacity
+    self._start = 0
+    self._count = 0
+
+  def __len__(self):
+    return self._count
+
+  def record(self, timestamp, current, target):
+    if self._count < self.capacity:
+      i = (self._start + self._count) % self.capacity
+      self._count += 1
+    else:
+      i = self._start
+      self._start = (self._start + 1) % self.capacity
+    self.times[i] = timestamp
+    self.currents[i] = current
+    self.targets[i] = target
+
+  def _index(self, n):
+    return (self._start + n) % self.capacity
+
+  def _bisect(self, timestamp):
+    # The number of samples recorded before `timestamp`
+    lo, hi = 0, self._count
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self.times[self._index(mid)] < timestamp: lo = mid + 1
+      else: hi = mid
+    return lo
+
+  def sample(self, n):
+    i = self._index(n)
+    return (self.times[i], self.currents[i], self.targets[i])
+
+  def samples(self, since, until):
+    start = max(self._bisect(since) - 1, 0)
+    for n in xrange(start, self._bisect(until)):
+      yield self.sample(n)
+
+  def downsample(self, since, until, points):
+    # Splits [since, until) into `points` buckets and returns a
+    # [time, min, max, avg, target] row for each one. The value held from the
+    # previous sample counts towards a bucket. Buckets before the first
+    # sample are left out.
+    if self._count == 0 or until <= since or points < 1: return []
+    width = float(until - since) / points
+    rows = []
+    held = None
+    bucket = 0
+    values = []
+    def close(bucket, values, target):
+      if len(values) == 0: return
+      rows.append([
+        since + bucket * width, min(values), max(values),
+        sum(values) / len(values), target
+      ])
+    for timestamp, current, target in self.samples(since, until):
+      n = min(int((timestamp - since) / width), points - 1)
+      if n < 0:
+        # The sample held at the start of the range
+        held = (current, target)
+        values = [current]
+        continue
+      while bucket < n:
+        close(bucket, values, held[1] if held else None)
+        bucket += 1
+        values = [held[0]] if held else []
+      values.append(current)
+      held = (current, target)
+    while bucket < points:
+      close(bucket, values, held[1] if held else None)
+      bucket += 1
+      values = [held[0]] if held else []
+    return rows
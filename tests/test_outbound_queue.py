@@ -0,0 +1,51 @@
+import os, sys, json, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "construct_server"))
+from broadcast_frame import BroadcastFrame
+from outbound_queue import OutboundQueue
+
+def change(target, data):
+  return dict(type= "change", target= target, data= data)
+
+class OutboundQueueTest(unittest.TestCase):
+  def test_coalesce_keeps_the_latest_event_per_path(self):
+    q = OutboundQueue(1024 * 1024, 1000)
+    for temp in [10, 20, 30]:
+      q.push(BroadcastFrame([change(["e0", "current_temp"], temp)]))
+    q.push(BroadcastFrame([change(["b0", "current_temp"], 40)]))
+    q.coalesce()
+    self.assertEqual(len(q), 1)
+    self.assertEqual(q.frames[0].events, [
+      change(["e0", "current_temp"], 30),
+      change(["b0", "current_temp"], 40)
+    ])
+    self.assertEqual(q.bytes, len(q.frames[0].payload))
+
+  def test_coalesce_keeps_frames_without_events(self):
+    q = OutboundQueue(1024 * 1024, 1000)
+    snapshot = BroadcastFrame(None, payload= json.dumps([dict(type= "initialized")]))
+    q.push(BroadcastFrame([change(["e0", "current_temp"], 10)]))
+    q.push(snapshot)
+    q.push(BroadcastFrame([change(["e0", "current_temp"], 20)]))
+    q.push(BroadcastFrame([change(["e0", "current_temp"], 30)]))
+    q.coalesce()
+    self.assertEqual(len(q), 3)
+    self.assertEqual(q.frames[0].events, [change(["e0", "current_temp"], 10)])
+    self.assertTrue(q.frames[1] is snapshot)
+    self.assertEqual(q.frames[2].events, [change(["e0", "current_temp"], 30)])
+
+  def test_resync_keeps_acks_and_session_events(self):
+    q = OutboundQueue(1024 * 1024, 1000)
+    ack = dict(type= "ack", data= dict(lines= 20))
+    progress = change(["session", "raw_block_progress"], dict(sent= 10, total= 20))
+    q.push(BroadcastFrame(None, payload= json.dumps([dict(type= "initialized")])))
+    q.push(BroadcastFrame([change(["e0", "current_temp"], 10), progress]))
+    q.push(BroadcastFrame([dict(type= "remove", target= ["jobs", 1]), ack]))
+    snapshot = BroadcastFrame(None, payload= json.dumps([dict(type= "initialized")]))
+    q.resync(snapshot)
+    self.assertEqual(len(q), 2)
+    self.assertTrue(q.frames[0] is snapshot)
+    self.assertEqual(q.frames[1].events, [progress, ack])
+    self.assertEqual(q.bytes, len(snapshot.payload) + len(q.frames[1].payload))
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,59 @@
+import os, sys, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "construct_server"))
+from tornado.concurrent import TracebackFuture
+from raw_pipeline import RawPipeline
+
+class FakePrinter(object):
+  # Holds do_raw calls until they are answered
+  def __init__(self):
+    self.calls = []
+
+  def call(self, name, *args):
+    future = TracebackFuture()
+    self.calls.append((name, args, future))
+    return future
+
+class FakeIOLoop(object):
+  def add_future(self, future, callback):
+    future.add_done_callback(callback)
+
+class RawPipelineTest(unittest.TestCase):
+  def setUp(self):
+    self.status = "idle"
+    self.printer = FakePrinter()
+    self.pipeline = RawPipeline(self.printer, FakeIOLoop(), window= 4,
+      can_send= lambda: self.status == "idle"
+    )
+
+  def answer(self, n= None):
+    while len(self.printer.calls) > 0 and n != 0:
+      name, args, future = self.printer.calls.pop(0)
+      if self.status == "idle": future.set_result(None)
+      else: future.set_exception(Exception("do_raw cancelled by do_estop"))
+      if n != None: n -= 1
+
+  def test_sends_every_line(self):
+    future = self.pipeline.send(["G1 X%i"%i for i in range(10)])
+    self.answer()
+    self.assertEqual(future.result(), dict(lines= 10))
+
+  def test_estop_fails_the_waiting_blocks(self):
+    first = self.pipeline.send(["G1 X%i"%i for i in range(40)])
+    second = self.pipeline.send(["G1 Y%i"%i for i in range(20)])
+    self.answer(2)
+    self.status = "estopped"
+    self.pipeline.cancel("Cancelled by an estop")
+    sent = 2 + len(self.printer.calls)
+    self.answer()
+    self.assertEqual(sent, 6)
+    self.assertTrue(first.exception() != None)
+    self.assertTrue(second.exception() != None)
+
+  def test_no_lines_are_sent_unless_idle(self):
+    self.status = "printing"
+    future = self.pipeline.send(["G28"])
+    self.assertEqual(self.printer.calls, [])
+    self.assertTrue(future.exception() != None)
+
+if __name__ == "__main__":
+  unittest.main()